@@ -0,0 +1,308 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""
+Benchmark the persistence layer.
+
+Runs each benchmark against every combination of database size, record
+size and database location given on the command line, and writes the
+results as JSON so that runs can be compared across commits.
+
+Usage: python benchmark.py [options]
+"""
+
+###############################################################################
+# Imports
+###############################################################################
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+from mud.object import Object
+from mud.store import store
+
+
+###############################################################################
+# Constants
+###############################################################################
+
+#: Approximate serialised record sizes, in bytes.
+RECORD_SIZES = {
+    "small": 100,
+    "medium": 1000,
+    "large": 10000,
+    }
+
+
+###############################################################################
+# Benchmark Object Class
+###############################################################################
+
+class BenchmarkObject(Object):
+    """
+    An object with a description and an inventory, sized to match one
+    of the record sizes.
+    """
+    def __init__(self, key, size=0):
+        Object.__init__(self, key)
+        
+        self.name = key
+        self.description = "x" * (size // 2)
+        self.inventory = ["item:%d" % i for i in xrange(size // 20)]
+        self.hp = 100
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def make_record(key, size):
+    """
+    Return a record of roughly the given size when serialised.
+    
+    Parameters:
+        key - The record's key.
+        size - The approximate size in bytes.
+    """
+    return BenchmarkObject(key, size).dump_data()
+
+def populate(keys, size):
+    """
+    Fill the store with records.
+    
+    Parameters:
+        keys - The number of records.
+        size - The approximate size in bytes of each record.
+    """
+    record = make_record("object:0", size)
+    
+    for i in xrange(0, keys, 10000):
+        store.set_many(("object:%d" % j, record)
+                       for j in xrange(i, min(i + 10000, keys)))
+        store.commit(override=True)
+
+def sample(keys, ops):
+    """
+    Return a list of random existing keys.
+    
+    Parameters:
+        keys - The number of records in the store.
+        ops - The number of keys to return.
+    """
+    return ["object:%d" % random.randrange(keys) for i in xrange(ops)]
+
+def bench_get(keys, size, ops):
+    for key in sample(keys, ops):
+        store[key]
+    return ops
+
+def bench_set(keys, size, ops):
+    record = make_record("object:0", size)
+    for key in sample(keys, ops):
+        store[key] = record
+    store.commit(override=True)
+    return ops
+
+def bench_contains(keys, size, ops):
+    for key in sample(keys, ops):
+        key in store
+    return ops
+
+def bench_select(keys, size, ops):
+    # Prefixes matching roughly 1/100th of the keys each.
+    count = 0
+    for i in xrange(max(ops // 100, 1)):
+        for key in store.select("object:%d%%" % random.randrange(10, 100)):
+            count += 1
+    return count
+
+def bench_commit(keys, size, ops):
+    record = make_record("object:0", size)
+    commits = max(ops // 10, 1)
+    for i, key in enumerate(sample(keys, commits)):
+        store[key] = record
+        store.commit()
+    return commits
+
+def bench_object_load(keys, size, ops):
+    for key in sample(keys, ops):
+        BenchmarkObject(key).load()
+    return ops
+
+def bench_object_dump(keys, size, ops):
+    for key in sample(keys, ops):
+        BenchmarkObject(key, size).dump()
+    store.commit(override=True)
+    return ops
+
+#: The benchmarks, by name. Each is called with the number of keys in
+#: the store, the record size and the number of operations to attempt,
+#: and returns the number of operations it performed.
+BENCHMARKS = [
+    ("store.get", bench_get),
+    ("store.set", bench_set),
+    ("store.contains", bench_contains),
+    ("store.select", bench_select),
+    ("store.commit", bench_commit),
+    ("object.load", bench_object_load),
+    ("object.dump", bench_object_dump),
+    ]
+
+def revision():
+    """
+    Return the current git revision, or None if it can't be found.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    
+    try:
+        process = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd=directory,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+    except OSError:
+        return None
+    
+    if process.returncode != 0:
+        return None
+    
+    return output.strip()
+
+def run(options):
+    """
+    Run the benchmarks and return the results as a dictionary.
+    
+    Parameters:
+        options - The parsed command line options.
+    """
+    connect = {
+        "cache_size": options.cache_size,
+        "durability": options.durability,
+        "codec": options.codec,
+        }
+    
+    results = []
+    directory = tempfile.mkdtemp(prefix="pantsmud-bench-")
+    
+    try:
+        for location in options.locations.split(","):
+            for keys in [int(k) for k in options.keys.split(",")]:
+                for size_name in options.record_sizes.split(","):
+                    size = RECORD_SIZES[size_name]
+                    
+                    if location == "disk":
+                        filename = os.path.join(directory, "bench-%d-%s.db" %
+                                                (keys, size_name))
+                    else:
+                        filename = ":memory:"
+                    
+                    store.connect(filename, **connect)
+                    populate(keys, size)
+                    
+                    for name, function in BENCHMARKS:
+                        if options.only and not name in options.only:
+                            continue
+                        
+                        random.seed(options.seed)
+                        ops = min(options.ops, keys)
+                        
+                        start = timer()
+                        count = function(keys, size, ops)
+                        elapsed = timer() - start
+                        
+                        result = {
+                            "benchmark": name,
+                            "location": location,
+                            "keys": keys,
+                            "record_size": size_name,
+                            "ops": count,
+                            "seconds": elapsed,
+                            "ops_per_second": count / elapsed if elapsed else None,
+                            }
+                        results.append(result)
+                        
+                        if options.verbose:
+                            sys.stderr.write("%-15s %-6s %8d %-6s %10.1f ops/s\n" % (
+                                name, location, keys, size_name,
+                                result["ops_per_second"] or 0))
+                    
+                    store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    return {
+        "revision": revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "connect": connect,
+        "results": results,
+        }
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-k", "--keys", default="1000,10000,100000",
+                      help="comma-separated database sizes, in keys "
+                           "(default: 1000,10000,100000; up to 1000000 "
+                           "is supported)")
+    parser.add_option("-r", "--record-sizes", default="small,medium,large",
+                      help="comma-separated record sizes out of small, "
+                           "medium and large (default: all)")
+    parser.add_option("-l", "--locations", default="memory,disk",
+                      help="comma-separated database locations out of "
+                           "memory and disk (default: both)")
+    parser.add_option("-n", "--ops", type="int", default=10000,
+                      help="operations per benchmark (default: 10000)")
+    parser.add_option("-b", "--benchmark", action="append", dest="only",
+                      help="only run the named benchmark; may be repeated")
+    parser.add_option("-c", "--cache-size", type="int", default=0,
+                      help="store cache size (default: no cache)")
+    parser.add_option("-d", "--durability", default="safe",
+                      help="store durability mode (default: safe)")
+    parser.add_option("--codec", default="json",
+                      help="store codec (default: json)")
+    parser.add_option("-s", "--seed", type="int", default=0,
+                      help="random seed (default: 0)")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write results to FILE instead of stdout")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="print progress to stderr")
+    options, args = parser.parse_args()
+    
+    report = run(options)
+    
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
@@ -0,0 +1,57 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+"""
+Re-encode a PantsMUD database in place with a different codec.
+
+Usage: python migrate.py [options] [filename]
+"""
+
+###############################################################################
+# Imports
+###############################################################################
+
+import optparse
+
+from mud.codec import codecs
+from mud.store import store
+
+import log
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] [filename]")
+    parser.add_option("-c", "--codec", default="json",
+                      choices=sorted(codecs),
+                      help="codec to re-encode rows with (default: json)")
+    parser.add_option("-z", "--compress", type="int", default=0,
+                      metavar="BYTES",
+                      help="compress rows of at least BYTES bytes")
+    parser.add_option("-b", "--batch-size", type="int", default=1000,
+                      help="rows to re-encode per commit (default: 1000)")
+    options, args = parser.parse_args()
+    
+    filename = args[0] if args else "pantsmud.db"
+    
+    store.connect(filename)
+    store.reencode(options.codec, options.compress, options.batch_size)
+    store.close()
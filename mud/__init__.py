@@ -20,9 +20,9 @@
 # Imports
 ###############################################################################
 
-from mud.component import Component, Extendable
+from mud.component import ColumnarComponent, Component, Extendable
 from mud.network import MUDConnection, MUDServer
-from mud.object import Object, Storable
+from mud.object import Object, Storable, flush_dirty
 from mud.store import store
 from mud.publisher import publisher
 
@@ -32,9 +32,9 @@ from mud.publisher import publisher
 ###############################################################################
 
 __all__ = [
-    "Component", "Extendable",
+    "ColumnarComponent", "Component", "Extendable",
     "MUDConnection", "MUDServer",
-    "Object", "Storable",
+    "Object", "Storable", "flush_dirty",
     "store",
     "publisher",
     ]
@@ -0,0 +1,191 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import json
+import marshal
+import sqlite3
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+###############################################################################
+# Codec Classes
+###############################################################################
+
+class Codec(object):
+    """
+    Serialises data for storage.
+    
+    Every row in the store is tagged with the name of the codec that
+    encoded it, so databases may freely mix codecs. A row tagged with
+    no codec at all is JSON, as written by older versions of the store.
+    """
+    #: The name the codec is registered and tagged under.
+    name = None
+    
+    #: Whether encode() produces binary rather than text data.
+    binary = False
+    
+    def encode(self, data):
+        """
+        Placeholder. Should return the serialised form of some data as
+        a string.
+        
+        Parameters:
+            data - The data to serialise.
+        """
+        raise NotImplementedError
+    
+    def decode(self, raw_data):
+        """
+        Placeholder. Should return the data serialised by encode().
+        
+        Parameters:
+            raw_data - Serialised data, as a string.
+        """
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    """
+    Encodes data as JSON text. Readable, portable and the default.
+    """
+    name = "json"
+    
+    def encode(self, data):
+        return json.dumps(data)
+    
+    def decode(self, raw_data):
+        return json.loads(raw_data)
+
+
+class MarshalCodec(Codec):
+    """
+    Encodes data with Python's marshal module. Considerably faster to
+    decode than JSON and more compact, but tied to the Python version
+    that wrote it.
+    """
+    name = "marshal"
+    binary = True
+    
+    def encode(self, data):
+        return marshal.dumps(data)
+    
+    def decode(self, raw_data):
+        return marshal.loads(raw_data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Encodes data with MessagePack. Compact, fast and portable. Only
+    available if the msgpack package is installed.
+    """
+    name = "msgpack"
+    binary = True
+    
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+    
+    def decode(self, raw_data):
+        return msgpack.unpackb(raw_data, raw=False)
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+#: The registered codecs, by name.
+codecs = {}
+
+def register(codec):
+    """
+    Register a codec so that it may be selected by name and its rows
+    decoded.
+    
+    Parameters:
+        codec - A Codec instance.
+    """
+    codecs[codec.name] = codec
+
+def encode(data, name="json", compress_threshold=0):
+    """
+    Return a (tag, serialised data) pair for some data. The serialised
+    data is ready to be bound to an SQLite statement.
+    
+    Parameters:
+        data - The data to serialise.
+        name - The name of the codec to use. Defaults to "json".
+        compress_threshold - If non-zero, serialised data of at least
+            this many bytes will be zlib-compressed. Defaults to 0.
+    """
+    codec = codecs[name]
+    raw_data = codec.encode(data)
+    
+    if compress_threshold and len(raw_data) >= compress_threshold:
+        return name + "+zlib", sqlite3.Binary(zlib.compress(raw_data))
+    elif codec.binary:
+        return name, sqlite3.Binary(raw_data)
+    
+    return name, raw_data
+
+def decode(tag, raw_data):
+    """
+    Return the data serialised in a row.
+    
+    Parameters:
+        tag - The row's codec tag, or None for untagged JSON rows.
+        raw_data - The row's serialised data.
+    """
+    if tag is None or tag == "json":
+        return json.loads(raw_data)
+    
+    name, _, compression = tag.partition("+")
+    
+    if compression == "zlib":
+        raw_data = zlib.decompress(raw_data)
+    elif compression:
+        raise ValueError("Unknown compression '%s'." % compression)
+    
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError("Unknown codec '%s'." % name)
+    
+    if codec.binary:
+        raw_data = str(raw_data)
+    
+    return codec.decode(raw_data)
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+register(JSONCodec())
+register(MarshalCodec())
+
+if msgpack is not None:
+    register(MsgpackCodec())
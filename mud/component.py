@@ -20,16 +20,43 @@
 # Imports
 ###############################################################################
 
+import array
 import weakref
+from collections import OrderedDict
+
+from mud.tracked import TrackedDict, TrackedList
+
+
+###############################################################################
+# Constants
+###############################################################################
+
+#: The type of the values held by arrays of each array module type
+#: code. Loaded values are converted to it, as stored data may hold a
+#: number of another type, such as a float in an integer field.
+TYPECODE_TYPES = dict([(typecode, int) for typecode in "bBhHiIlL"] +
+                      [(typecode, float) for typecode in "fd"] +
+                      [("c", str), ("u", unicode)])
 
 
 ###############################################################################
 # Globals
 ###############################################################################
 
-#: The central component registry.
+#: The central component registry. Maps each class to the components
+#: added to it directly, in the order they were added.
 _class_components = {}
 
+#: A cache of each class' resolved components, including those of its
+#: ancestors. Maps each class to a (spec, lookup) pair, where spec is a
+#: tuple of (name, ComponentClass) pairs and lookup a dictionary of
+#: the same. Cleared whenever a component is added.
+_specs = {}
+
+#: An index of component names to weak sets of the objects that have
+#: them, used by with_components().
+_owners = {}
+
 
 ###############################################################################
 # Extendable Class
@@ -43,32 +70,67 @@ class Extendable(object):
     instance of the extendable class will have its own, unique instance
     of each component class that has been added. This is particularly
     useful for modular, loosely-coupled designs.
+    
+    Components are created lazily, the first time they are accessed as
+    attributes, so the components dictionary only holds the components
+    that have been used. Until then, a component's stored data is kept
+    as it was loaded.
+    
+    Components may also be attached to, or detached from, individual
+    instances at runtime. Every instance is indexed by the names of its
+    components, which with_components() uses to find the objects that
+    have a given set of components.
     """
     def __init__(self):
         """
         Initialises the extendable object.
         """
         self.components = {}
+        self._component_data = {}
+        
+        _index(self, _resolve(self.__class__)[1])
     
     def __getattr__(self, key):
         """
         Called when attribute 'key' cannot be found on the object. If a
-        component named 'key' exists, it will be returned. Otherwise, an
+        component named 'key' exists, it will be returned, and created
+        from its stored data if this is its first use. Otherwise, an
         AttributeError will be raised.
         
         Parameters:
             key - The name of an attribute.
         """
-        try:
-            return self.components[key]
-        except KeyError:
-            raise AttributeError("'%s' object has no attribute '%s'" % (
-                                 self.__class__.__name__, key))
+        # Looked up through __dict__, so that a missing attribute during
+        # initialisation cannot recurse back into __getattr__.
+        components = self.__dict__.get("components")
+        
+        if components is not None:
+            try:
+                return components[key]
+            except KeyError:
+                pass
+            
+            Component = _resolve(self.__class__)[1].get(key)
+            if Component is not None and not key in self.__dict__.get(
+                    "_detached", ()):
+                component = Component(self)
+                
+                data = self._component_data.pop(key, None)
+                if data is not None:
+                    component.load_data(data)
+                
+                component._tracked = True
+                components[key] = component
+                return component
+        
+        raise AttributeError("'%s' object has no attribute '%s'" % (
+                             self.__class__.__name__, key))
     
     @classmethod
     def add_component(cls, ComponentClass, name=None):
         """
-        Add a component to this class.
+        Add a component to this class. Subclasses inherit the component
+        unless they add one of the same name.
         
         Parameters:
             ComponentClass - The class object that will be used to
@@ -81,39 +143,72 @@ class Extendable(object):
             name = ComponentClass.__name__.lower()
         
         if not cls in _class_components:
-            _class_components[cls] = {}
+            _class_components[cls] = OrderedDict()
         
         _class_components[cls][name] = ComponentClass
+        _specs.clear()
+    
+    def attach_component(self, component, name=None):
+        """
+        Attach a component to this instance only, replacing any
+        component of the same name.
+        
+        Parameters:
+            component - The component instance.
+            name - An optional string argument specifying the name of
+                this component. If not provided, it will default to the
+                lowercased name of the component's class.
+        """
+        if not name:
+            name = component.__class__.__name__.lower()
+        
+        self.__dict__.get("_detached", set()).discard(name)
+        self._component_data.pop(name, None)
+        component._tracked = True
+        self.components[name] = component
+        
+        _index(self, (name,))
+    
+    def detach_component(self, name):
+        """
+        Detach a component, and discard its data, from this instance.
+        
+        Parameters:
+            name - The name of the component.
+        """
+        self.components.pop(name, None)
+        self._component_data.pop(name, None)
+        
+        if name in _resolve(self.__class__)[1]:
+            self.__dict__.setdefault("_detached", set()).add(name)
+        
+        if name in _owners:
+            _owners[name].discard(self)
     
     def load_data_components(self, data={}):
         """
-        Creates components for this instance and loads relevant data.
+        Stores this instance's component data. Each component is created,
+        and passed its data, on first access.
         
         Parameters:
             data - A dictionary containing this instance's component
                 data.
         """
-        cls = self.__class__
-        
-        if not cls in _class_components:
-            return
+        self.components = {}
+        self._component_data = dict(data)
         
-        for name, Component in _class_components[cls].iteritems():
-            component = Component(self)
-            
-            if name in data:
-                component.load_data(data[name])
-            
-            self.components[name] = component
+        _index(self, _resolve(self.__class__)[1])
     
     def dump_data_components(self):
         """
         Returns a dictionary containing this instance's component data.
+        The data of components that have not been created is returned
+        as it was loaded.
         """
-        data = {}
+        data = dict(self._component_data)
         
         for name, component in self.components.iteritems():
-            data[key] = component.dump_data()
+            data[name] = component.dump_data()
         
         return data
 
@@ -123,6 +218,13 @@ class Extendable(object):
 ###############################################################################
 
 class Component(object):
+    __slots__ = ("_owner", "_tracked", "__weakref__")
+    
+    #: The names of attributes whose lists and dictionaries are wrapped
+    #: in tracked containers, so that changing them in place marks the
+    #: owner as dirty.
+    tracked = ()
+    
     def __init__(self, owner):
         """
         Initialises the component.
@@ -132,6 +234,47 @@ class Component(object):
                 to.
         """
         self._owner = weakref.ref(owner)
+        self._tracked = False # Set once created and loaded by the owner.
+    
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute. Once the component has been created and
+        loaded by its owner, setting any non-private attribute marks the
+        owner as dirty. Lists and dictionaries set on tracked attributes
+        are wrapped in tracked containers.
+        
+        Parameters:
+            name - The name of the attribute.
+            value - The attribute's new value.
+        """
+        if name in self.tracked:
+            if type(value) is list:
+                value = TrackedList(self, value)
+            elif type(value) is dict:
+                value = TrackedDict(self, value)
+        
+        object.__setattr__(self, name, value)
+        
+        if name[0] != "_":
+            self.mark_dirty()
+    
+    def mark_dirty(self):
+        """
+        Marks the owner as changed, if it tracks changes, so that it
+        will be saved by the next flush. Does nothing until the
+        component has been created and loaded by its owner, so that
+        loading it, which may change tracked containers in place, does
+        not mark the owner as dirty.
+        """
+        if not getattr(self, "_tracked", False):
+            return
+        
+        owner = self._owner()
+        
+        if owner is not None:
+            mark_dirty = getattr(owner, "mark_dirty", None)
+            if mark_dirty is not None:
+                mark_dirty()
     
     @property
     def owner(self):
@@ -155,3 +298,307 @@ class Component(object):
         can be JSON-serialised.
         """
         return {}
+
+
+###############################################################################
+# Columns Class
+###############################################################################
+
+class Columns(object):
+    """
+    Column storage for the instances of a columnar component class. Each
+    field is held in an array with one row per component instance, so
+    a system can iterate, or operate on, every instance's value of a
+    field at once.
+    
+    The rows of collected components are reused, and reset to their
+    fields' defaults when they are, so a system may safely operate on
+    whole columns, including unused rows.
+    """
+    def __init__(self, fields):
+        """
+        Initialises the columns.
+        
+        Parameters:
+            fields - A sequence of (name, typecode, default) tuples,
+                where typecode is an array module type code.
+        """
+        self.fields = tuple(fields)
+        self.arrays = dict((name, array.array(typecode))
+                           for name, typecode, default in self.fields)
+        self.owners = [] # row -> weak reference to owner, or None.
+        self._free = []
+    
+    def __getitem__(self, name):
+        """
+        Returns the array holding field 'name'.
+        
+        Parameters:
+            name - The name of a field.
+        """
+        return self.arrays[name]
+    
+    def __len__(self):
+        """
+        Returns the number of rows in use.
+        """
+        return len(self.owners) - len(self._free)
+    
+    def allocate(self, owner):
+        """
+        Returns a row for a new component instance, set to the fields'
+        defaults.
+        
+        Parameters:
+            owner - A weak reference to the component's owner.
+        """
+        if self._free:
+            row = self._free.pop()
+            for name, typecode, default in self.fields:
+                self.arrays[name][row] = default
+            self.owners[row] = owner
+        else:
+            row = len(self.owners)
+            for name, typecode, default in self.fields:
+                self.arrays[name].append(default)
+            self.owners.append(owner)
+        
+        return row
+    
+    def release(self, row):
+        """
+        Marks a row as unused.
+        
+        Parameters:
+            row - The row of a collected component instance.
+        """
+        self.owners[row] = None
+        self._free.append(row)
+    
+    def rows(self):
+        """
+        Returns a list of the rows that are in use.
+        """
+        return [row for row, owner in enumerate(self.owners)
+                if owner is not None]
+    
+    def items(self):
+        """
+        Returns a list of (row, owner) pairs for the rows in use whose
+        owners are still alive.
+        """
+        items = []
+        
+        for row, owner in enumerate(self.owners):
+            if owner is not None:
+                owner = owner()
+                if owner is not None:
+                    items.append((row, owner))
+        
+        return items
+
+
+###############################################################################
+# ColumnarComponent Class
+###############################################################################
+
+class ColumnarType(type):
+    """
+    The metaclass of columnar components. Gives every class that
+    declares fields its own Columns, holding both its inherited and its
+    own fields, and a property for each field.
+    """
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault("__slots__", ())
+        cls = type.__new__(mcs, name, bases, attrs)
+        
+        if "fields" in attrs:
+            # Inherited fields come first, so a subclass' columns hold
+            # every field its inherited methods and properties use. A
+            # field redeclared by the subclass replaces the inherited one.
+            fields = OrderedDict()
+            for base in reversed(cls.__mro__[1:]):
+                for field in base.__dict__.get("fields", ()):
+                    fields[field[0]] = field
+            for field in attrs["fields"]:
+                fields[field[0]] = field
+            
+            cls.fields = tuple(fields.itervalues())
+            cls.columns = Columns(cls.fields)
+            
+            for field, typecode, default in cls.fields:
+                setattr(cls, field, _column(field))
+        
+        return cls
+
+
+class ColumnarComponent(Component):
+    """
+    A component whose data is held in its class' columns rather than in
+    each instance.
+    
+    Subclasses declare their fields as a sequence of (name, typecode,
+    default) tuples, where typecode is an array module type code:
+    
+        class Health(ColumnarComponent):
+            fields = (("hp", "i", 100), ("regen", "f", 1.0))
+    
+    A subclass that declares fields of its own also inherits those of
+    its ancestors, and gets columns of its own holding all of them.
+    
+    Instances are light views onto a row of Health.columns, and read and
+    write their fields as ordinary attributes. Systems may instead work
+    on every instance at once through the columns:
+    
+        hp, regen = Health.columns["hp"], Health.columns["regen"]
+        for row in Health.columns.rows():
+            hp[row] += int(regen[row])
+    
+    Subclasses have no instance dictionary, so any other state must be
+    declared in __slots__. Systems which write to the columns directly
+    should call mark_dirty() on the owners they change.
+    """
+    __metaclass__ = ColumnarType
+    __slots__ = ("_row",)
+    
+    fields = ()
+    
+    def __init__(self, owner):
+        """
+        Initialises the component and allocates its row.
+        
+        Parameters:
+            owner - A reference to the object this component is attached
+                to.
+        """
+        Component.__init__(self, owner)
+        self._row = self.columns.allocate(self._owner)
+    
+    def __del__(self):
+        row = getattr(self, "_row", None)
+        if row is not None:
+            self.columns.release(row)
+    
+    def load_data(self, data):
+        """
+        Loads this instance's fields from deserialised data, converting
+        each value to its field's type.
+        
+        Parameters:
+            data - Deserialised data.
+        """
+        arrays = self.columns.arrays
+        
+        for name, typecode, default in self.fields:
+            if name in data:
+                arrays[name][self._row] = TYPECODE_TYPES[typecode](data[name])
+    
+    def dump_data(self):
+        """
+        Returns this instance's fields in a form that can be
+        JSON-serialised.
+        """
+        arrays = self.columns.arrays
+        
+        return dict((name, arrays[name][self._row])
+                    for name, typecode, default in self.fields)
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def component_spec(cls):
+    """
+    Returns a tuple of (name, ComponentClass) pairs for every component
+    of a class, including those inherited from its ancestors, in the
+    order they were added, most distant ancestor first.
+    
+    Parameters:
+        cls - An extendable class.
+    """
+    return _resolve(cls)[0]
+
+def with_components(*names):
+    """
+    Returns a list of the live objects that have every one of the given
+    components, whether created yet or not.
+    
+    Parameters:
+        *names - The names of the components.
+    """
+    sets = []
+    
+    for name in names:
+        owners = _owners.get(name)
+        if not owners:
+            return []
+        sets.append(owners)
+    
+    if not sets:
+        return []
+    
+    sets.sort(key=len)
+    smallest, others = sets[0], sets[1:]
+    
+    return [owner for owner in smallest
+            if all(owner in owners for owners in others)]
+
+def _resolve(cls):
+    """
+    Returns the cached (spec, lookup) pair of a class' components,
+    resolving them across its MRO if they are not yet cached.
+    
+    Parameters:
+        cls - An extendable class.
+    """
+    try:
+        return _specs[cls]
+    except KeyError:
+        pass
+    
+    components = OrderedDict()
+    
+    for klass in reversed(cls.__mro__):
+        for name, Component in _class_components.get(klass, {}).iteritems():
+            # A subclass' component replaces its ancestor's in place.
+            components[name] = Component
+    
+    resolved = _specs[cls] = (tuple(components.iteritems()), dict(components))
+    return resolved
+
+def _index(owner, names):
+    """
+    Adds an object to the component index under each of the given
+    component names, except those detached from it.
+    
+    Parameters:
+        owner - An extendable object.
+        names - The names of its components.
+    """
+    detached = owner.__dict__.get("_detached", ())
+    
+    for name in names:
+        if name in detached:
+            continue
+        
+        try:
+            _owners[name].add(owner)
+        except KeyError:
+            _owners[name] = weakref.WeakSet((owner,))
+
+def _column(name):
+    """
+    Returns a property which reads and writes field 'name' of a
+    columnar component's row.
+    
+    Parameters:
+        name - The name of a field.
+    """
+    def get(self):
+        return self.columns.arrays[name][self._row]
+    
+    def set(self, value):
+        self.columns.arrays[name][self._row] = value
+    
+    return property(get, set)
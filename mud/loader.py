@@ -0,0 +1,149 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import logging
+import multiprocessing
+import time
+
+from mud.codec import decode
+from mud.object import LAZY_PREFIX, identity_map
+from mud.store import store
+
+log = logging.getLogger("pants")
+
+
+###############################################################################
+# Constants
+###############################################################################
+
+#: The number of rows handed to a decoding process at a time.
+CHUNK_SIZE = 2000
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def load_prefix(cls, prefix, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Loads every object whose key begins with the given prefix, such as
+    a whole zone at startup, and returns a (objects, timings) pair.
+    
+    Loading happens in three phases. The rows are read from the store
+    in a single query. They are then decoded in chunks on a pool of
+    processes. Finally, the objects are created and loaded on the
+    calling thread, and registered in the identity map. As with get(),
+    an object that is already live is returned as it is rather than
+    being loaded again. Components are created lazily, on first access,
+    as usual.
+    
+    timings is a dictionary of the seconds spent in each phase ("read",
+    "decode" and "materialise"), the total, and the number of objects
+    loaded.
+    
+    Parameters:
+        cls - The Object subclass to create.
+        prefix - The key prefix.
+        processes - The number of decoding processes. If None, one per
+            CPU is used. If 0 or 1, or there is only a single chunk,
+            rows are decoded on the calling thread. Defaults to None.
+        chunk_size - The number of rows per chunk. Defaults to
+            CHUNK_SIZE.
+    """
+    timings = {}
+    start = time.time()
+    
+    # Read. Binary data is read as buffers, which cannot be pickled.
+    chunks = []
+    chunk = []
+    
+    for key, tag, raw_data in store.scan_raw(prefix):
+        if key.startswith(LAZY_PREFIX):
+            continue
+        
+        if isinstance(raw_data, buffer):
+            raw_data = str(raw_data)
+        
+        chunk.append((key, tag, raw_data))
+        if len(chunk) >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+    
+    if chunk:
+        chunks.append(chunk)
+    
+    timings["read"] = time.time() - start
+    
+    # Decode.
+    phase = time.time()
+    
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    
+    if processes > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(chunks)))
+        try:
+            chunks = pool.map(_decode_chunk, chunks, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chunks = [_decode_chunk(chunk) for chunk in chunks]
+    
+    timings["decode"] = time.time() - phase
+    
+    # Materialise.
+    phase = time.time()
+    objects = []
+    
+    for chunk in chunks:
+        for key, data in chunk:
+            obj = identity_map.get(key)
+            
+            if not isinstance(obj, cls):
+                # The data was decoded afresh, so need not be copied.
+                obj = cls(key)
+                obj.load_unshared(data)
+                obj.mark_clean()
+            
+            objects.append(obj)
+    
+    timings["materialise"] = time.time() - phase
+    timings["total"] = time.time() - start
+    timings["objects"] = len(objects)
+    
+    log.info("Loaded %d objects with prefix '%s' in %.2fs (read %.2fs, "
+             "decode %.2fs, materialise %.2fs)." % (len(objects), prefix,
+             timings["total"], timings["read"], timings["decode"],
+             timings["materialise"]))
+    
+    return objects, timings
+
+
+def _decode_chunk(rows):
+    """
+    Decodes a chunk of rows. Runs in a decoding process.
+    
+    Parameters:
+        rows - A list of (key, codec, serialised data) tuples.
+    """
+    return [(key, decode(tag, raw_data)) for key, tag, raw_data in rows]
@@ -20,12 +20,23 @@
 # Imports
 ###############################################################################
 
+import weakref
+
 from mud.publisher import publisher
 from mud.state import State
 
+from pants import callback
 from pants.contrib.telnet import TelnetConnection, TelnetServer
 
 
+###############################################################################
+# Constants
+###############################################################################
+
+#: The encoding of text written to connections.
+ENCODING = "utf-8"
+
+
 ###############################################################################
 # MUDConnection Class
 ###############################################################################
@@ -36,6 +47,7 @@ class MUDConnection(TelnetConnection):
         
         self.line_inbuf = []
         self.state_stack = []
+        self.outbuf = []
     
     def on_connect(self):
         publisher.publish("mud.connection.connect", self)
@@ -53,7 +65,63 @@ class MUDConnection(TelnetConnection):
             pass
         
     def on_close(self):
+        self.outbuf = []
+        self.server.forget(self)
         publisher.publish("mud.connection.close", self)
+    
+    def write(self, data, flush=False):
+        """
+        Queue data to be written to the connection. Everything written
+        during an iteration of the engine is sent in a single write at
+        the start of the next, or when flush() is called.
+        
+        Parameters:
+            data - A string. Unicode is encoded with ENCODING.
+            flush - If True, the queued data is written to the
+                connection now, and the connection is asked to flush
+                it. Defaults to False.
+        """
+        if isinstance(data, unicode):
+            data = data.encode(ENCODING)
+        
+        self._queue(data)
+        
+        if flush:
+            self.flush(True)
+    
+    def flush(self, flush=False):
+        """
+        Write any queued data to the connection now.
+        
+        Parameters:
+            flush - Passed on to the connection's write. Defaults to
+                False.
+        """
+        if self.outbuf:
+            data = "".join(self.outbuf)
+            self.outbuf = []
+            TelnetConnection.write(self, data, flush)
+    
+    def end(self):
+        """
+        Write any queued data to the connection and close it once
+        everything has been sent. Data still queued when close() is
+        called is discarded.
+        """
+        self.flush()
+        TelnetConnection.end(self)
+    
+    def _queue(self, data):
+        """
+        Queue encoded data, scheduling a flush if none is pending.
+        
+        Parameters:
+            data - An encoded string.
+        """
+        if not self.outbuf:
+            self.server.schedule_flush(self)
+        
+        self.outbuf.append(data)
         
     def push_state(self, state):
         try:
@@ -83,4 +151,111 @@ class MUDConnection(TelnetConnection):
 ###############################################################################
 
 class MUDServer(TelnetServer):
+    """
+    A telnet server for MUDConnections.
+    
+    Output written to the server's connections is flushed once per
+    iteration of the engine. Messages may be broadcast to every
+    connection, to a named group of connections, such as the players in
+    a room or on a chat channel, or to any other set of connections.
+    Broadcast messages are encoded once and the same string is queued
+    on every connection.
+    """
     ConnectionClass = MUDConnection
+    
+    def __init__(self, *args, **kwargs):
+        TelnetServer.__init__(self, *args, **kwargs)
+        
+        self.groups = {} # name -> WeakSet of connections
+        self._flushing = set()
+        self._flush_scheduled = False
+    
+    def join(self, group, connection):
+        """
+        Add a connection to a broadcast group.
+        
+        Parameters:
+            group - The name of the group.
+            connection - The connection.
+        """
+        try:
+            self.groups[group].add(connection)
+        except KeyError:
+            self.groups[group] = weakref.WeakSet((connection,))
+    
+    def leave(self, group, connection):
+        """
+        Remove a connection from a broadcast group.
+        
+        Parameters:
+            group - The name of the group.
+            connection - The connection.
+        """
+        members = self.groups.get(group)
+        
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.groups[group]
+    
+    def forget(self, connection):
+        """
+        Remove a closed connection from every group and drop any output
+        waiting to be flushed to it.
+        
+        Parameters:
+            connection - The connection.
+        """
+        self._flushing.discard(connection)
+        
+        for group in self.groups.keys():
+            self.leave(group, connection)
+    
+    def broadcast(self, data, group=None, connections=None, exclude=None):
+        """
+        Queue a message on a number of connections, encoding it once.
+        
+        Parameters:
+            data - A string. Unicode is encoded with ENCODING.
+            group - The name of a group to send the message to.
+            connections - An iterable of connections to send the message
+                to. If neither a group nor connections are given, the
+                message is sent to every connection.
+            exclude - An optional connection not to send the message to,
+                such as the speaker's.
+        """
+        if isinstance(data, unicode):
+            data = data.encode(ENCODING)
+        
+        if group is not None:
+            connections = list(self.groups.get(group, ()))
+        elif connections is None:
+            connections = self.channels.values()
+        
+        for connection in connections:
+            if connection is not exclude:
+                connection._queue(data)
+    
+    def schedule_flush(self, connection):
+        """
+        Flush a connection's output on the next iteration of the engine.
+        
+        Parameters:
+            connection - A connection with queued output.
+        """
+        self._flushing.add(connection)
+        
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            callback(self.flush)
+    
+    def flush(self):
+        """
+        Flush the output of every connection with queued output.
+        """
+        connections = self._flushing
+        self._flushing = set()
+        self._flush_scheduled = False
+        
+        for connection in connections:
+            connection.flush()
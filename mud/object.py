@@ -20,12 +20,147 @@
 # Imports
 ###############################################################################
 
+import weakref
+from collections import OrderedDict
 from copy import deepcopy
 
 from mud.component import Extendable
+from mud.tracked import TRACKED_TYPES, TrackedDict, TrackedList
+from mud.publisher import publisher
 from mud.store import store
 
 
+###############################################################################
+# Constants
+###############################################################################
+
+#: Types whose values can be serialised and never need to be copied.
+IMMUTABLE_TYPES = frozenset((str, unicode, int, float, bool))
+
+#: Types whose values can be serialised.
+SERIALISABLE_TYPES = (basestring, list, tuple, dict, int, float)
+
+#: The number of recently used objects the identity map keeps alive.
+IDENTITY_MAP_SIZE = 1000
+
+#: The prefix of the keys under which lazy attributes are stored. It
+#: keeps them out of the key range of the objects themselves, so that
+#: prefix scans only find objects.
+LAZY_PREFIX = "__lazy__:"
+
+#: The format of the keys under which an object's lazy attributes are
+#: stored, given the object's key and the attribute's name.
+LAZY_KEY = LAZY_PREFIX + "%s#%s"
+
+#: The name under which an object's data lists its stored lazy
+#: attributes. Private, so it can never clash with an attribute.
+LAZY_FIELDS = "_lazy"
+
+
+###############################################################################
+# Globals
+###############################################################################
+
+#: A cache of each Object subclass' Schema.
+_schemas = {}
+
+#: The storable objects that have changed since they were last loaded
+#: or dumped.
+_dirty = set()
+
+
+###############################################################################
+# IdentityMap Class
+###############################################################################
+
+class IdentityMap(object):
+    """
+    A registry of live storable objects by key, so that each key is
+    represented by at most one object.
+    
+    Objects are held through weak references, so the map does not keep
+    them alive, except for the most recently used, which are also held
+    strongly in a bounded LRU so that they stay warm.
+    """
+    def __init__(self, size=IDENTITY_MAP_SIZE):
+        """
+        Initialise the identity map.
+        
+        Parameters:
+            size - The number of recently used objects to keep alive.
+        """
+        self.size = size
+        self._objects = weakref.WeakValueDictionary()
+        self._recent = OrderedDict()
+    
+    def __len__(self):
+        return len(self._objects)
+    
+    def __contains__(self, key):
+        return key in self._objects
+    
+    def get(self, key):
+        """
+        Return the live object for a key and mark it as recently used,
+        or None if there is no live object for the key.
+        
+        Parameters:
+            key - The key to look up.
+        """
+        storable = self._objects.get(key)
+        
+        if storable is not None:
+            self._touch(key, storable)
+        
+        return storable
+    
+    def add(self, storable):
+        """
+        Register an object under its key, replacing any other object
+        registered under the key.
+        
+        Parameters:
+            storable - A Storable instance.
+        """
+        self._objects[storable.key] = storable
+        self._touch(storable.key, storable)
+    
+    def discard(self, key):
+        """
+        Forget the object registered under a key, if any.
+        
+        Parameters:
+            key - The key to forget.
+        """
+        self._objects.pop(key, None)
+        self._recent.pop(key, None)
+    
+    def clear(self):
+        """
+        Forget every object.
+        """
+        self._objects.clear()
+        self._recent.clear()
+    
+    def _touch(self, key, storable):
+        """
+        Mark an object as the most recently used, evicting the least
+        recently used from the strong tier if it is full.
+        
+        Parameters:
+            key - The object's key.
+            storable - The object.
+        """
+        if not self.size:
+            return
+        
+        self._recent.pop(key, None)
+        self._recent[key] = storable
+        
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+
+
 ###############################################################################
 # Storable Class
 ###############################################################################
@@ -33,6 +168,18 @@ from mud.store import store
 class Storable(object):
     """
     A mixin class which provides basic storage capabilities.
+    
+    Once an instance has been loaded or dumped, setting any non-private
+    attribute marks it as dirty until it is next loaded or dumped, and
+    flush_dirty() dumps every dirty instance at once. Instances that
+    have never been loaded or dumped are not tracked, so discarding one
+    never writes it to the store.
+    
+    Instances are registered in the identity map under their keys once
+    they have been loaded or dumped, so the map only ever holds objects
+    whose data matches the store. Use get() rather than creating and
+    loading an instance to reuse the live instance for a key, if there
+    is one.
     """
     def __init__(self, key):
         """
@@ -43,26 +190,165 @@ class Storable(object):
         """
         self.key = key
     
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute, marking the instance as dirty if the
+        attribute is not private.
+        
+        Parameters:
+            name - The name of the attribute.
+            value - The attribute's new value.
+        """
+        object.__setattr__(self, name, value)
+        
+        if name[0] != "_" and self.__dict__.get("_attached"):
+            _dirty.add(self)
+    
+    @property
+    def dirty(self):
+        """
+        Whether this instance has changed since it was last loaded or
+        dumped.
+        """
+        return self in _dirty
+    
+    def mark_dirty(self):
+        """
+        Marks this instance as changed, for changes that setting an
+        attribute does not reveal, such as modifying a list in place.
+        Does nothing if the instance has never been loaded or dumped.
+        """
+        if self.__dict__.get("_attached"):
+            _dirty.add(self)
+    
+    def mark_clean(self):
+        """
+        Marks this instance as matching the store, as it does once it
+        has been loaded or dumped, registers it in the identity map and
+        starts tracking its changes.
+        """
+        self._attached = True
+        _dirty.discard(self)
+        identity_map.add(self)
+    
+    @classmethod
+    def get(cls, key, dump=False):
+        """
+        Returns the live instance for a key, if there is one. Otherwise
+        creates an instance and loads it from the store.
+        
+        Parameters:
+            key - A unique string identifying the instance.
+            dump - If True, a new instance that is not yet in the store
+                will be dumped to it. Defaults to False.
+        """
+        storable = identity_map.get(key)
+        
+        if not isinstance(storable, cls):
+            storable = cls(key)
+            storable.load(dump)
+        
+        return storable
+    
+    @classmethod
+    def get_many(cls, keys, dump=False):
+        """
+        Returns a list of the instances for the given keys, reusing live
+        instances and loading the rest from the store at once.
+        
+        Parameters:
+            keys - An iterable of keys.
+            dump - If True, new instances that are not yet in the store
+                will be dumped to it. Defaults to False.
+        """
+        storables = []
+        missing = {}
+        
+        for key in keys:
+            storable = identity_map.get(key)
+            
+            if not isinstance(storable, cls):
+                storable = missing.get(key)
+                if storable is None:
+                    storable = missing[key] = cls(key)
+            
+            storables.append(storable)
+        
+        if missing:
+            Storable.load_many(missing.itervalues(), dump)
+        
+        return storables
+    
     def load(self, dump=False):
         """
         Loads this instance's data from the store.
         """
-        if self.key in store:
+        try:
             data = store[self.key]
-        else:
+            found = True
+        except KeyError:
             data = {}
+            found = False
         
-        self.load_data(data)
+        # Data read from an unbuffered store is decoded afresh, so
+        # nothing else holds a reference to it.
+        if store.buffered:
+            self.load_data(data)
+        else:
+            self.load_unshared(data)
+        self.mark_clean()
         
-        if dump and not self.key in store:
+        if dump and not found:
             self.dump()
     
     def dump(self):
         """
         Dumps this instance's data to the store.
         """
-        data = self.dump_data()
-        store[self.key] = data
+        store.set_many(self.dump_rows())
+        self.mark_clean()
+    
+    @staticmethod
+    def load_many(storables, dump=False):
+        """
+        Loads the data of many instances from the store at once.
+        
+        Parameters:
+            storables - An iterable of Storable instances.
+            dump - If True, instances that are not yet in the store will
+                be dumped to it. Defaults to False.
+        """
+        storables = list(storables)
+        found = store.get_many([s.key for s in storables])
+        
+        for storable in storables:
+            if store.buffered:
+                storable.load_data(found.get(storable.key, {}))
+            else:
+                storable.load_unshared(found.get(storable.key, {}))
+            storable.mark_clean()
+        
+        if dump:
+            Storable.dump_many(s for s in storables if not s.key in found)
+    
+    @staticmethod
+    def dump_many(storables):
+        """
+        Dumps the data of many instances to the store at once.
+        
+        Parameters:
+            storables - An iterable of Storable instances.
+        """
+        storables = list(storables)
+        
+        rows = []
+        for storable in storables:
+            rows.extend(storable.dump_rows())
+        
+        store.set_many(rows)
+        
+        for storable in storables:
+            storable.mark_clean()
     
     def load_data(self, data):
         """
@@ -79,6 +365,74 @@ class Storable(object):
         can be JSON-serialised.
         """
         return {}
+    
+    def load_unshared(self, data):
+        """
+        Loads deserialised data that nothing else holds a reference to,
+        such as data just decoded from the database, so that it need not
+        be copied. Defaults to load_data().
+        
+        Parameters:
+            data - Deserialised data.
+        """
+        self.load_data(data)
+    
+    def dump_unshared(self):
+        """
+        Returns this instance's data for the store, which need not be
+        copied if the store does not keep a reference to it. Defaults to
+        dump_data().
+        """
+        return self.dump_data()
+    
+    def dump_rows(self):
+        """
+        Returns a list of the (key, data) rows to write to the store to
+        dump this instance, so that many instances can be written in a
+        single batch. Defaults to this instance's own row.
+        """
+        return [(self.key, self.dump_unshared())]
+
+
+###############################################################################
+# Schema Class
+###############################################################################
+
+class Schema(object):
+    """
+    The serialisation details of an Object subclass, resolved once and
+    cached: whether it overrides storable(), which attributes hold
+    tracked containers or are lazy, and the load_data_foo and
+    dump_data_foo hooks of each of its attributes.
+    """
+    def __init__(self, cls):
+        """
+        Initialise the schema.
+        
+        Parameters:
+            cls - An Object subclass.
+        """
+        self.cls = cls
+        self.custom_storable = cls.storable.im_func is not Object.storable.im_func
+        self.tracked = frozenset(cls.tracked)
+        self.lazy = frozenset(cls.lazy)
+        self._hooks = {}
+    
+    def hooks(self, attr):
+        """
+        Returns a (load hook, dump hook) pair of unbound methods for an
+        attribute. Either may be None if the class defines no hook.
+        
+        Parameters:
+            attr - The name of an attribute.
+        """
+        try:
+            return self._hooks[attr]
+        except KeyError:
+            hooks = self._hooks[attr] = (
+                getattr(self.cls, "load_data_%s" % attr, None),
+                getattr(self.cls, "dump_data_%s" % attr, None))
+            return hooks
 
 
 ###############################################################################
@@ -99,12 +453,72 @@ class Object(Storable, Extendable):
     
     When loading/dumping an attribute 'foo', the existence of a method
     'load_data_foo'/'dump_data_foo' will be checked for. If found, said
-    method will be called rather than setattr/getattr.
+    method will be called rather than setattr/getattr. These methods are
+    looked up once per class and attribute, and cached in the class'
+    Schema.
+    
+    Mutable values are deep copied on their way in and out, so that the
+    object never shares them with the data it was loaded from or dumped
+    to. The load() and dump() methods skip the copies when the store is
+    unbuffered, as it then keeps no reference to the data.
+    
+    Changing a list or dictionary in place does not mark an object as
+    dirty. Attributes named in the class' tracked attribute are instead
+    wrapped in a TrackedList or TrackedDict when set, which marks the
+    object as dirty whenever it is modified.
+    
+    Large, rarely read attributes may be named in the class' lazy
+    attribute. Each is stored under its own key (see LAZY_KEY) rather
+    than in the object's data, and is only fetched from the store the
+    first time it is accessed after loading. dump_data() returns the
+    lazy attributes that have been fetched along with the rest of the
+    data, and dump_rows() splits them out into their own rows. Lazy
+    attributes that have not been accessed are left as they are in the
+    store when the object is dumped.
     """
+    tracked = ()
+    lazy = ()
+    
     def __init__(self, key):
         Storable.__init__(self, key)
         Extendable.__init__(self)
     
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute, wrapping lists and dictionaries set on
+        tracked attributes in tracked containers.
+        
+        Parameters:
+            name - The name of the attribute.
+            value - The attribute's new value.
+        """
+        if name in _schema(self.__class__).tracked:
+            if type(value) is list:
+                value = TrackedList(self, value)
+            elif type(value) is dict:
+                value = TrackedDict(self, value)
+        
+        Storable.__setattr__(self, name, value)
+    
+    def __getattr__(self, name):
+        """
+        Called when attribute 'name' cannot be found on the object. If
+        it is a lazy attribute that has not yet been fetched, it is
+        fetched from the store. Otherwise, the object's components are
+        checked.
+        
+        Parameters:
+            name - The name of an attribute.
+        """
+        pending = self.__dict__.get("_lazy_pending")
+        
+        if pending and name in pending:
+            pending.discard(name)
+            self._fetch_lazy(name)
+            return getattr(self, name)
+        
+        return Extendable.__getattr__(self, name)
+    
     def storable(self):
         """
         Returns this instance's list of storable attributes.
@@ -118,46 +532,224 @@ class Object(Storable, Extendable):
         Parameters:
             data - Deserialised data.
         """
-        attrs = self.storable()
+        self._load_data(data, True)
+    
+    def load_unshared(self, data):
+        """
+        Loads deserialised data that nothing else holds a reference to,
+        without copying it.
         
-        for attr in attrs:
-            if not hasattr(self, attr):
+        Parameters:
+            data - Deserialised data.
+        """
+        self._load_data(data, False)
+    
+    def dump_data(self):
+        """
+        Return this instance's data in a form that can be
+        JSON-serialised.
+        """
+        return self._dump_data(True)
+    
+    def dump_unshared(self):
+        """
+        Return this instance's data for the store, copying mutable
+        values only if the store keeps a reference to them.
+        """
+        return self._dump_data(store.buffered)
+    
+    def dump_rows(self):
+        """
+        Returns a list of the (key, data) rows to write to the store to
+        dump this instance: its own row, followed by a row for each lazy
+        attribute that has been fetched or set.
+        """
+        data = self.dump_unshared()
+        
+        lazy = _schema(self.__class__).lazy.intersection(data)
+        if not lazy:
+            return [(self.key, data)]
+        
+        rows = [(LAZY_KEY % (self.key, attr), data.pop(attr))
+                for attr in sorted(lazy)]
+        
+        data[LAZY_FIELDS] = sorted(lazy.union(data.get(LAZY_FIELDS, ())))
+        rows.insert(0, (self.key, data))
+        
+        return rows
+    
+    def _load_data(self, data, copy):
+        """
+        Loads this instance's deserialised data.
+        
+        Parameters:
+            data - Deserialised data.
+            copy - Whether to deep copy mutable values.
+        """
+        schema = _schema(self.__class__)
+        
+        # Lazy attributes that have been stored separately are dropped,
+        # to be fetched when they are first accessed.
+        pending = set(data.get(LAZY_FIELDS, ())) & schema.lazy
+        pending.difference_update(data)
+        self._lazy_pending = pending
+        for attr in pending:
+            self.__dict__.pop(attr, None)
+        
+        for attr in self.storable():
+            if schema.custom_storable and not hasattr(self, attr):
                 raise AttributeError("'%s' object has no attribute '%s'" %
-                                 (self.__class__.__name__, key))
+                                 (self.__class__.__name__, attr))
             
             if not attr in data:
                 continue
             
-            if hasattr(self, "load_data_%s" % attr):
-                getattr(self, "load_data_%s" % attr)(deepcopy(data[attr]))
+            value = data[attr]
+            if copy and not type(value) in IMMUTABLE_TYPES:
+                value = deepcopy(value)
+            
+            load = schema.hooks(attr)[0]
+            if load is not None:
+                load(self, value)
             else:
-                setattr(self, attr, deepcopy(data[attr]))
+                setattr(self, attr, value)
     
-    def dump_data(self):
+    def _dump_data(self, copy):
         """
         Return this instance's data in a form that can be
         JSON-serialised.
+        
+        Parameters:
+            copy - Whether to deep copy mutable attribute values. The
+                values returned by dump_data_foo methods are always
+                copied, as they may be shared with the instance.
         """
         attrs = self.storable()
         
-        if not attrs:
+        if not attrs and not self.__dict__.get("_lazy_pending"):
             return {}
         
+        schema = _schema(self.__class__)
+        
         data = {}
         for attr in attrs:
-            if not hasattr(self, attr):
+            if schema.custom_storable and not hasattr(self, attr):
                 raise AttributeError("'%s' object has no attribute '%s'" %
-                                 (self.__class__.__name__, key))
+                                 (self.__class__.__name__, attr))
             
-            if hasattr(self, "dump_data_%s" % attr):
-                value = getattr(self, "dump_data_%s" % attr)()
+            dump = schema.hooks(attr)[1]
+            if dump is not None:
+                value = dump(self)
             else:
                 value = getattr(self, attr)
             
-            if not isinstance(value, (basestring, list, tuple, dict, int, float)):
-                # TODO Perhaps this should be a call to log.error()
-                raise ValueError("Attribute '%s' contains data that cannot be serialised." % attr)
+            if not type(value) in IMMUTABLE_TYPES:
+                if not isinstance(value, SERIALISABLE_TYPES):
+                    # TODO Perhaps this should be a call to log.error()
+                    raise ValueError("Attribute '%s' contains data that cannot be serialised." % attr)
+                
+                if copy or dump is not None or type(value) in TRACKED_TYPES:
+                    value = deepcopy(value)
             
-            data[attr] = deepcopy(value)
+            data[attr] = value
+        
+        # Lazy attributes that have not been fetched are still stored.
+        pending = self.__dict__.get("_lazy_pending")
+        if pending:
+            pending = pending.difference(data)
+            if pending:
+                data[LAZY_FIELDS] = sorted(pending)
         
         return data
+    
+    def _fetch_lazy(self, attr):
+        """
+        Fetches a lazy attribute from the store, without marking the
+        object as dirty.
+        
+        Parameters:
+            attr - The name of the attribute.
+        """
+        try:
+            value = store[LAZY_KEY % (self.key, attr)]
+        except KeyError:
+            return
+        
+        if store.buffered and not type(value) in IMMUTABLE_TYPES:
+            value = deepcopy(value)
+        
+        dirty = self in _dirty
+        
+        load = _schema(self.__class__).hooks(attr)[0]
+        if load is not None:
+            load(self, value)
+        else:
+            setattr(self, attr, value)
+        
+        if not dirty:
+            _dirty.discard(self)
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def flush_dirty():
+    """
+    Dumps every dirty storable object to the store in a single batch,
+    and returns the number of objects dumped. Intended to be called
+    before each commit, and called when the global store is closed.
+    """
+    if not _dirty:
+        return 0
+    
+    storables = list(_dirty)
+    _dirty.clear()
+    
+    try:
+        rows = []
+        for storable in storables:
+            rows.extend(storable.dump_rows())
+        
+        store.set_many(rows)
+    except Exception:
+        _dirty.update(storables)
+        raise
+    
+    return len(storables)
+
+def _flush_on_close(closing):
+    """
+    Dumps every dirty storable object before the global store closes,
+    including on shutdown, so that changes made since the last flush
+    are not lost.
+    
+    Parameters:
+        closing - The store that is closing.
+    """
+    if closing is store:
+        flush_dirty()
+
+def _schema(cls):
+    """
+    Returns the cached Schema of an Object subclass, creating it if
+    necessary.
+    
+    Parameters:
+        cls - An Object subclass.
+    """
+    try:
+        return _schemas[cls]
+    except KeyError:
+        schema = _schemas[cls] = Schema(cls)
+        return schema
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+#: The global identity map.
+identity_map = IdentityMap()
+
+publisher.subscribe("mud.store.close", _flush_on_close)
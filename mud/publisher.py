@@ -20,10 +20,334 @@
 # Logging
 ###############################################################################
 
+import heapq
 import logging
+import Queue
+import sys
+import threading
+import time
+import weakref
+
+from pants import loop
+
 log = logging.getLogger("pants")
 
 
+###############################################################################
+# Constants
+###############################################################################
+
+#: Priorities for deferred events. Lower values are delivered first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+#: The upper bounds, in seconds, of the latency histogram buckets kept
+#: by instrumented publishers. A final bucket counts anything slower.
+LATENCY_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+
+#: The number of threads in a publisher's worker pool.
+POOL_SIZE = 4
+
+
+###############################################################################
+# DeferredEvent Class
+###############################################################################
+
+class DeferredEvent(object):
+    """
+    An event queued by Publisher.publish_deferred().
+    """
+    __slots__ = ("event", "args", "kwargs", "priority", "coalesce",
+                 "cancelled")
+    
+    def __init__(self, event, args, kwargs, priority, coalesce=None):
+        self.event = event
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.coalesce = coalesce
+        self.cancelled = False
+
+
+###############################################################################
+# Timing Class
+###############################################################################
+
+class Timing(object):
+    """
+    Call count, cumulative time and latency histogram for an event or
+    handler of an instrumented publisher.
+    """
+    __slots__ = ("calls", "total", "max", "slow", "buckets")
+    
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0 # Calls that exceeded the publisher's threshold.
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    
+    def add(self, elapsed):
+        """
+        Record a call.
+        
+        Args:
+            elapsed: The call's duration in seconds.
+        """
+        self.calls += 1
+        self.total += elapsed
+        
+        if elapsed > self.max:
+            self.max = elapsed
+        
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+    
+    def snapshot(self):
+        """
+        Returns the timing as a dictionary.
+        """
+        return {
+            "calls": self.calls,
+            "total": self.total,
+            "average": self.total / self.calls if self.calls else 0.0,
+            "max": self.max,
+            "slow": self.slow,
+            "histogram": list(self.buckets),
+            }
+
+
+###############################################################################
+# WeakHandler Class
+###############################################################################
+
+class WeakHandler(object):
+    """
+    A weak reference to an event handler.
+    
+    Like weakref.WeakMethod, a bound method is referenced through its
+    instance, so subscribing a bound method does not keep the instance
+    alive. Calling a WeakHandler calls the handler if it is still alive
+    and does nothing otherwise.
+    """
+    __slots__ = ("_ref", "_func", "__weakref__")
+    
+    def __init__(self, handler, callback=None):
+        """
+        Initialises the weak handler.
+        
+        Args:
+            handler: A function or bound method.
+            callback: An optional callable that will be passed the
+                dead reference once the handler has been collected.
+        """
+        if getattr(handler, "im_self", None) is not None:
+            self._ref = weakref.ref(handler.im_self, callback)
+            self._func = handler.im_func
+        else:
+            self._ref = weakref.ref(handler, callback)
+            self._func = None
+    
+    def __call__(self, *args, **kwargs):
+        handler = self.resolve()
+        
+        if handler is not None:
+            return handler(*args, **kwargs)
+    
+    def __eq__(self, other):
+        if isinstance(other, WeakHandler):
+            other = other.resolve()
+        
+        handler = self.resolve()
+        return handler is not None and handler == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = None
+    
+    @property
+    def alive(self):
+        """
+        Whether the handler has not yet been collected.
+        """
+        return self._ref() is not None
+    
+    def resolve(self):
+        """
+        Returns the handler, or None if it has been collected.
+        """
+        target = self._ref()
+        
+        if target is None or self._func is None:
+            return target
+        
+        return self._func.__get__(target, type(target))
+
+
+###############################################################################
+# WorkerPool Class
+###############################################################################
+
+class WorkerPool(object):
+    """
+    A bounded pool of threads which runs blocking event handlers away
+    from the engine.
+    
+    The outcome of each job is put on a thread-safe queue, which
+    deliver() empties on the engine thread on every iteration: results
+    are passed to the job's result handler, if it has one, and
+    exceptions are logged.
+    """
+    def __init__(self, size=POOL_SIZE, max_queue=0):
+        """
+        Initialise the pool. Threads are started on the first submit.
+        
+        Args:
+            size: The number of worker threads.
+            max_queue: The number of jobs that may wait for a worker.
+                Once it is reached, submit() blocks. Zero means
+                unbounded.
+        """
+        self.size = size
+        self.queue = Queue.Queue(max_queue)
+        self.outcomes = Queue.Queue() # (function, argument) pairs.
+        self.threads = []
+        self._delivering = False
+    
+    def submit(self, function, args=(), kwargs=None, on_result=None):
+        """
+        Queue a job to run on a worker thread.
+        
+        Args:
+            function: The callable to run.
+            args: Positional arguments to pass to the callable.
+            kwargs: Keyword arguments to pass to the callable.
+            on_result: An optional callable which will be passed the
+                callable's return value on the engine thread.
+        """
+        if not self.threads:
+            self.start()
+        
+        self.queue.put((function, args, kwargs or {}, on_result))
+    
+    def start(self):
+        """
+        Start the worker threads, and the engine loop that delivers
+        their outcomes.
+        """
+        if not self._delivering:
+            self._delivering = True
+            loop(self.deliver)
+        
+        for i in xrange(self.size):
+            thread = threading.Thread(target=self._work,
+                                      name="publisher-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def stop(self):
+        """
+        Run any queued jobs, then stop the worker threads and wait for
+        them to finish.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        
+        for thread in self.threads:
+            thread.join()
+        
+        self.threads = []
+        self.deliver()
+    
+    def deliver(self):
+        """
+        Deliver the outcomes of finished jobs. Must be called on the
+        engine thread.
+        """
+        while True:
+            try:
+                function, argument = self.outcomes.get_nowait()
+            except Queue.Empty:
+                break
+            
+            try:
+                function(argument)
+            except Exception:
+                log.exception("Exception raised while delivering a result.")
+    
+    def _work(self):
+        """
+        The worker threads' main loop.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            
+            function, args, kwargs, on_result = job
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                self.outcomes.put((_log_exception, sys.exc_info()))
+            else:
+                if on_result is not None:
+                    self.outcomes.put((on_result, result))
+
+
+###############################################################################
+# BlockingHandler Class
+###############################################################################
+
+class BlockingHandler(object):
+    """
+    An event handler which is run on a worker pool rather than inline.
+    Calling a BlockingHandler queues the handler and returns at once.
+    """
+    __slots__ = ("handler", "pool", "on_result")
+    
+    def __init__(self, handler, pool, on_result=None):
+        """
+        Initialises the blocking handler.
+        
+        Args:
+            handler: The handler, possibly a WeakHandler.
+            pool: The WorkerPool to run the handler on.
+            on_result: An optional callable which will be passed the
+                handler's return value on the engine thread.
+        """
+        self.handler = handler
+        self.pool = pool
+        self.on_result = on_result
+    
+    def __call__(self, *args, **kwargs):
+        self.pool.submit(self.handler, args, kwargs, self.on_result)
+    
+    def __eq__(self, other):
+        if isinstance(other, BlockingHandler):
+            other = other.handler
+        
+        return self.handler == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = None
+    
+    @property
+    def alive(self):
+        """
+        Whether the wrapped handler, if weak, has not been collected.
+        """
+        return getattr(self.handler, "alive", True)
+
+
 ###############################################################################
 # Publisher Class
 ###############################################################################
@@ -35,9 +359,47 @@ class Publisher(object):
     This class may be directly instantiated to create a standalone
     publisher object, or it may be inherited by another class to provide
     pub/sub capabilities to instances of that class.
+    
+    Event names are hierarchical, with levels separated by dots, such as
+    "mud.connection.connect". A subscription may use "*" in place of a
+    level: a "*" in the middle of a name matches exactly one level,
+    while a trailing "*" matches one or more levels, so "mud.*" receives
+    every event beneath "mud".
+    
+    The handlers for each published event are resolved once into an
+    immutable dispatch table, which is reused until a subscription
+    changes, so publishing does not allocate.
+    
+    Handlers may be subscribed weakly, in which case they are
+    unsubscribed automatically once they are garbage collected.
+    
+    Publishing can be instrumented with instrument(), which records
+    the time spent in each event and handler and logs slow handlers.
+    Uninstrumented publishers pay nothing for this.
+    
+    Events may also be deferred with publish_deferred(), which queues
+    them to be delivered by drain(), in priority order and within a
+    time budget, on a later iteration of the engine.
+    
+    Handlers that block, such as those doing DNS lookups or file I/O,
+    may be subscribed with executor="pool" so that they run on the
+    publisher's worker pool instead of stalling the engine.
     """
     def __init__(self):
-        self._events = {}
+        self._events = {} # name or pattern -> ((order, handler), ...)
+        self._dispatch = {} # event -> (handler, ...)
+        self._order = 0
+        
+        self.budget = 0.01 # Seconds drain() may spend per call.
+        self._queue = [] # Heap of (priority, sequence, deferred event).
+        self._coalesced = {} # (event, key) -> deferred event.
+        self._sequence = 0
+        
+        self.threshold = None # Seconds after which a handler is slow.
+        self._event_timings = {} # event -> Timing
+        self._handler_timings = {} # handler name -> Timing
+        
+        self._pool = None # Created when first needed.
     
     @classmethod
     def instance(cls):
@@ -49,15 +411,31 @@ class Publisher(object):
         
         return cls._instance
     
-    def event(self, event):
+    @property
+    def pool(self):
+        """
+        The WorkerPool that runs handlers subscribed with
+        executor="pool".
+        """
+        if self._pool is None:
+            self._pool = WorkerPool()
+            self.subscribe("pants.engine.stop", self._pool.stop)
+        
+        return self._pool
+    
+    def event(self, event, weak=False, executor=None, on_result=None):
         """
         Decorator. Subscribe a function to an event.
         
         Args:
             event: The event identifier.
+            weak: If True, the function is subscribed weakly.
+            executor: If "pool" or a WorkerPool, the function is run
+                on that pool rather than on the engine thread.
+            on_result: See subscribe().
         """
         def decorator(handler):
-            self.subscribe(event, handler)
+            self.subscribe(event, handler, weak, executor, on_result)
             return handler
         
         return decorator
@@ -71,28 +449,184 @@ class Publisher(object):
             *args: Positional arguments to be passed to subscribers.
             **kwargs: Keyword arguments to be passed to subscribers.
         """
-        if not event in self._events:
-            return
+        try:
+            handlers = self._dispatch[event]
+        except KeyError:
+            handlers = self._resolve(event)
         
-        for handler in self._events[event][:]:
+        for handler in handlers:
             try:
                 handler(*args, **kwargs)
             except Exception:
                 log.exception("Exception raised while executing event.")
     
-    def subscribe(self, event, handler):
+    def _publish_instrumented(self, event, *args, **kwargs):
         """
-        Subscribe a handler to an event.
+        Publish an event, recording how long it and each of its
+        handlers take. Replaces publish() while instrumentation is
+        enabled.
         
         Args:
             event: The event identifier.
+            *args: Positional arguments to be passed to subscribers.
+            **kwargs: Keyword arguments to be passed to subscribers.
+        """
+        try:
+            handlers = self._dispatch[event]
+        except KeyError:
+            handlers = self._resolve(event)
+        
+        clock = time.time
+        event_start = clock()
+        
+        for handler in handlers:
+            start = clock()
+            
+            try:
+                handler(*args, **kwargs)
+            except Exception:
+                log.exception("Exception raised while executing event.")
+            
+            elapsed = clock() - start
+            name = handler_name(handler)
+            
+            timing = self._handler_timings.get(name)
+            if timing is None:
+                timing = self._handler_timings[name] = Timing()
+            timing.add(elapsed)
+            
+            if self.threshold is not None and elapsed > self.threshold:
+                timing.slow += 1
+                log.warning("Handler %s took %.1fms to handle '%s'." % (
+                            name, elapsed * 1000, event))
+        
+        timing = self._event_timings.get(event)
+        if timing is None:
+            timing = self._event_timings[event] = Timing()
+        timing.add(clock() - event_start)
+    
+    def publish_deferred(self, event, *args, **kwargs):
+        """
+        Queue an event to be published by a later call to drain().
+        
+        Two keyword arguments are consumed by this method rather than
+        passed to subscribers: priority, one of PRIORITY_HIGH,
+        PRIORITY_NORMAL (the default) or PRIORITY_LOW; and coalesce, a
+        hashable key. If an event with the same name and coalesce key is
+        still queued, it is delivered once only, with the arguments of
+        the most recent call.
+        
+        Args:
+            event: The event identifier.
+            *args: Positional arguments to be passed to subscribers.
+            **kwargs: Keyword arguments to be passed to subscribers.
+        """
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        coalesce = kwargs.pop("coalesce", None)
+        
+        if coalesce is not None:
+            queued = self._coalesced.get((event, coalesce))
+            
+            if queued is not None:
+                queued.args = args
+                queued.kwargs = kwargs
+                
+                if priority >= queued.priority:
+                    return
+                
+                # Promote the queued event by re-queueing it.
+                queued.cancelled = True
+        
+        deferred = DeferredEvent(event, args, kwargs, priority, coalesce)
+        
+        if coalesce is not None:
+            self._coalesced[(event, coalesce)] = deferred
+        
+        self._sequence += 1
+        heapq.heappush(self._queue, (priority, self._sequence, deferred))
+    
+    def drain(self, budget=None):
+        """
+        Publish queued events, highest priority first, until the queue
+        is empty or the time budget has been spent. At least one event
+        is published per call, so the queue always makes progress.
+        Returns the number of events published.
+        
+        This should be called once per iteration of the engine.
+        
+        Args:
+            budget: The number of seconds to spend. If None, the
+                publisher's budget attribute is used.
+        """
+        if not self._queue:
+            return 0
+        
+        if budget is None:
+            budget = self.budget
+        
+        deadline = time.time() + budget
+        count = 0
+        
+        while self._queue:
+            priority, sequence, deferred = heapq.heappop(self._queue)
+            
+            if deferred.cancelled:
+                continue # Superseded by a promoted copy.
+            
+            if deferred.coalesce is not None:
+                del self._coalesced[(deferred.event, deferred.coalesce)]
+            
+            self.publish(deferred.event, *deferred.args, **deferred.kwargs)
+            count += 1
+            
+            if time.time() >= deadline:
+                break
+        
+        return count
+    
+    def pending(self):
+        """
+        Returns the number of deferred events waiting to be published.
+        """
+        return sum(1 for p, s, deferred in self._queue if not deferred.cancelled)
+    
+    def subscribe(self, event, handler, weak=False, executor=None,
+                  on_result=None):
+        """
+        Subscribe a handler to an event.
+        
+        Args:
+            event: The event identifier, which may contain wildcards.
             handler: A callable that will be executed when the event is
                 published.
+            weak: If True, only a weak reference to the handler (or, for
+                a bound method, to its instance) is kept, and the
+                handler is unsubscribed once it is garbage collected.
+            executor: If "pool", the handler is blocking and is run on
+                the publisher's worker pool rather than on the engine
+                thread. A WorkerPool may also be given. Exceptions are
+                logged on the engine thread.
+            on_result: An optional callable which will be passed the
+                return value of a pooled handler, on the engine thread.
         """
-        if not event in self._events:
-            self._events[event] = []
+        if weak:
+            handler = WeakHandler(handler, self._collected)
         
-        self._events[event].append(handler)
+        if executor == "pool":
+            executor = self.pool
+        
+        if executor is not None:
+            handler = BlockingHandler(handler, executor, on_result)
+        elif on_result is not None:
+            raise ValueError("on_result requires an executor.")
+        
+        self._order += 1
+        
+        # Subscriptions are immutable tuples, replaced rather than
+        # modified, so a publish in progress is never affected.
+        entry = (self._order, handler)
+        self._events[event] = self._events.get(event, ()) + (entry,)
+        self._dispatch = {}
     
     def unsubscribe(self, event=None, handler=None):
         """
@@ -108,12 +642,221 @@ class Publisher(object):
             event: The event identifier.
             handler: A callable subscribed to some number of events.
         """
-        if event is None:
+        if event is None and handler is None:
             self._events = {}
         elif handler is None:
-            self._events[event] = []
+            self._events.pop(event, None)
+        elif event is None:
+            for event, entries in self._events.items():
+                self._events[event] = tuple(e for e in entries
+                                            if e[1] != handler)
         else:
-            self._events[event].remove(handler)
+            entries = self._events.get(event, ())
+            for i, (order, subscriber) in enumerate(entries):
+                if subscriber == handler:
+                    self._events[event] = entries[:i] + entries[i + 1:]
+                    break
+            else:
+                raise ValueError("Handler is not subscribed to '%s'." % event)
+        
+        self._dispatch = {}
+    
+    def instrument(self, enabled=True, threshold=None):
+        """
+        Enable or disable timing instrumentation. While enabled, every
+        publish records call counts, cumulative time and a latency
+        histogram for the event and for each handler. Disabling it
+        restores the uninstrumented publish() but keeps the recorded
+        timings.
+        
+        Args:
+            enabled: Whether to instrument publishing.
+            threshold: If given, handlers that take longer than this
+                many seconds are logged as slow.
+        """
+        self.threshold = threshold
+        
+        if enabled:
+            self.publish = self._publish_instrumented
+        else:
+            self.__dict__.pop("publish", None)
+    
+    def timings(self):
+        """
+        Returns a snapshot of the recorded timings: a dictionary with
+        an "events" dictionary keyed by event and a "handlers"
+        dictionary keyed by handler name. Times are in seconds, and the
+        histogram buckets are bounded by LATENCY_BUCKETS.
+        """
+        return {
+            "events": dict((event, timing.snapshot()) for event, timing
+                           in self._event_timings.iteritems()),
+            "handlers": dict((name, timing.snapshot()) for name, timing
+                             in self._handler_timings.iteritems()),
+            }
+    
+    def format_timings(self, limit=20):
+        """
+        Returns the recorded timings as a human-readable table of the
+        events and handlers that have taken the most time, suitable for
+        an administrator's dump.
+        
+        Args:
+            limit: The number of events and of handlers to include.
+        """
+        lines = []
+        
+        for title, timings in (("Event", self._event_timings),
+                               ("Handler", self._handler_timings)):
+            lines.append("%-48s %8s %10s %9s %9s %6s" % (
+                         title, "Calls", "Total ms", "Avg ms", "Max ms",
+                         "Slow"))
+            
+            ranked = sorted(timings.iteritems(), key=lambda i: -i[1].total)
+            for name, timing in ranked[:limit]:
+                lines.append("%-48s %8d %10.1f %9.3f %9.3f %6d" % (
+                             str(name)[:48], timing.calls,
+                             timing.total * 1000,
+                             timing.total * 1000 / timing.calls,
+                             timing.max * 1000, timing.slow))
+            
+            lines.append("")
+        
+        return "\n".join(lines)
+    
+    def reset_timings(self):
+        """
+        Discard every recorded timing.
+        """
+        self._event_timings = {}
+        self._handler_timings = {}
+    
+    def report(self):
+        """
+        Returns a dictionary mapping each subscribed event identifier or
+        pattern to its number of live subscribers. Useful for finding
+        handlers that are never unsubscribed.
+        """
+        report = {}
+        
+        for event, entries in self._events.iteritems():
+            count = sum(1 for order, handler in entries
+                        if getattr(handler, "alive", True))
+            if count:
+                report[event] = count
+        
+        return report
+    
+    def _collected(self, ref):
+        """
+        Called when a weakly subscribed handler has been garbage
+        collected. Prunes every dead handler.
+        
+        Args:
+            ref: The dead weak reference.
+        """
+        for event, entries in self._events.items():
+            entries = tuple(e for e in entries
+                            if getattr(e[1], "alive", True))
+            
+            if entries:
+                self._events[event] = entries
+            else:
+                del self._events[event]
+        
+        self._dispatch = {}
+    
+    def _resolve(self, event):
+        """
+        Build, cache and return the dispatch table for an event: every
+        handler subscribed to its name or to a matching pattern, in the
+        order they were subscribed.
+        
+        Args:
+            event: The event identifier.
+        """
+        entries = list(self._events.get(event, ()))
+        
+        for pattern, subscribed in self._events.iteritems():
+            # Any hashable may identify an event, but only strings can
+            # be patterns.
+            if (pattern != event and isinstance(pattern, basestring) and
+                    "*" in pattern and matches(pattern, event)):
+                entries.extend(subscribed)
+        
+        entries.sort()
+        handlers = tuple(handler for order, handler in entries)
+        self._dispatch[event] = handlers
+        
+        return handlers
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def handler_name(handler):
+    """
+    Returns a readable name for an event handler.
+    
+    Args:
+        handler: A handler, as passed to subscribe().
+    """
+    if isinstance(handler, BlockingHandler):
+        handler = handler.handler
+    
+    if isinstance(handler, WeakHandler):
+        handler = handler.resolve()
+        if handler is None:
+            return "<dead handler>"
+    
+    name = getattr(handler, "__name__", None)
+    if name is None:
+        return repr(handler)
+    
+    owner = getattr(handler, "im_class", None)
+    if owner is not None:
+        return "%s.%s.%s" % (owner.__module__, owner.__name__, name)
+    
+    return "%s.%s" % (getattr(handler, "__module__", "?"), name)
+
+def _log_exception(exc_info):
+    """
+    Log an exception raised by a pooled handler. Called on the engine
+    thread.
+    
+    Args:
+        exc_info: The exception, as returned by sys.exc_info().
+    """
+    log.error("Exception raised while executing event.", exc_info=exc_info)
+
+def matches(pattern, event):
+    """
+    Test whether an event name matches a subscription pattern.
+    
+    Args:
+        pattern: A subscription pattern, such as "mud.connection.*".
+        event: An event name, such as "mud.connection.connect".
+    """
+    if not isinstance(event, basestring):
+        return False
+    
+    pattern = pattern.split(".")
+    event = event.split(".")
+    
+    if pattern[-1] == "*":
+        if len(event) < len(pattern):
+            return False
+        event = event[:len(pattern) - 1]
+        pattern = pattern[:-1]
+    elif len(event) != len(pattern):
+        return False
+    
+    for expected, actual in zip(pattern, event):
+        if expected != "*" and expected != actual:
+            return False
+    
+    return True
 
 # Gloabl publisher object.
 publisher = Publisher.instance()
\ No newline at end of file
@@ -20,11 +20,19 @@
 # Imports
 ###############################################################################
 
-import json
+import heapq
+import itertools
 import os
+import Queue
 import sqlite3
+import sys
+import threading
+import time
 import UserDict
+import zlib
+from collections import OrderedDict
 
+from mud.codec import codecs, decode, encode
 from mud.publisher import publisher
 
 from mud.shared import log
@@ -36,9 +44,34 @@ from mud.shared import log
 
 SCHEMA = """CREATE TABLE pants_data (
     key TEXT UNIQUE PRIMARY KEY NOT NULL,
-    data TEXT NOT NULL
+    data TEXT NOT NULL,
+    codec TEXT
 );"""
 
+INDEX_SCHEMA = """CREATE TABLE IF NOT EXISTS pants_index (
+    field TEXT NOT NULL,
+    value NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (field, value, key)
+);
+CREATE INDEX IF NOT EXISTS pants_index_key ON pants_index (key);
+CREATE TABLE IF NOT EXISTS pants_index_fields (
+    field TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    PRIMARY KEY (field, prefix)
+);"""
+
+#: Insert a row, or replace the data of an existing row with that key.
+UPSERT = """INSERT INTO pants_data (key, data, codec) VALUES (?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET data=excluded.data, codec=excluded.codec"""
+
+#: The supported durability modes. See Store.connect().
+DURABILITY_MODES = ("safe", "wal", "group")
+
+#: The maximum number of keys bound to a single IN (...) query. SQLite
+#: builds prior to 3.32 refuse statements with more than 999 variables.
+MAX_VARIABLES = 500
+
 
 ###############################################################################
 # Exceptions
@@ -48,71 +81,596 @@ class NotConnectedError(Exception):
     pass
 
 
+###############################################################################
+# Functions
+###############################################################################
+
+def prefix_range(prefix):
+    """
+    Return a (start, end) pair of keys such that every key beginning
+    with the given prefix is greater than or equal to start and less
+    than end. End is None if there is no upper bound. Both are text, as
+    keys are stored as text; byte strings are decoded as UTF-8.
+    
+    Parameters:
+        prefix - A key prefix.
+    """
+    if isinstance(prefix, str):
+        prefix = prefix.decode("utf-8")
+    
+    start = prefix
+    
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            return start, prefix[:-1] + unichr(last + 1)
+        prefix = prefix[:-1] # No successor for the last character.
+    
+    return start, None
+
+
+def index_value(data, field):
+    """
+    Return the indexable value of a field of some deserialised data, or
+    None if there is no such value. Only string and numeric values can
+    be indexed.
+    
+    Parameters:
+        data - Deserialised data.
+        field - The name of the field.
+    """
+    if not isinstance(data, dict):
+        return None
+    
+    value = data.get(field)
+    if isinstance(value, (basestring, int, long, float)):
+        return value
+    
+    return None
+
+
+###############################################################################
+# Cache Class
+###############################################################################
+
+class Cache(object):
+    """
+    A least-recently-used cache of deserialised store records.
+    
+    The cache may be bounded by a number of entries, by an approximate
+    memory size or by both. The size of an entry is taken to be the
+    length of its serialised form. When either bound is exceeded, the
+    least recently used entries are evicted until the cache fits again.
+    
+    Hit, miss and eviction counters are kept so that the cache can be
+    sized against real workloads.
+    """
+    def __init__(self, max_items=0, max_bytes=0):
+        """
+        Initialise the cache.
+        
+        Parameters:
+            max_items - The maximum number of entries to hold. Zero
+                means no limit. Defaults to 0.
+            max_bytes - The maximum total size of the held entries, in
+                bytes of serialised data. Zero means no limit. Defaults
+                to 0.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        
+        self._entries = OrderedDict() # key -> (data, size)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def get(self, key):
+        """
+        Return the cached data for a key and mark it as recently used.
+        Raises KeyError if the key is not cached.
+        
+        Parameters:
+            key - The key to look up.
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        
+        self._entries[key] = entry # Re-insert as most recently used.
+        self.hits += 1
+        
+        return entry[0]
+    
+    def put(self, key, data, size):
+        """
+        Add or replace a cache entry, evicting older entries if the
+        cache grows beyond its bounds.
+        
+        Parameters:
+            key - The entry's key.
+            data - The deserialised data.
+            size - The length of the serialised data.
+        """
+        self.discard(key)
+        
+        if self.max_bytes and size > self.max_bytes:
+            return # Would evict everything, including itself.
+        
+        self._entries[key] = (data, size)
+        self.size += size
+        
+        while ((self.max_items and len(self._entries) > self.max_items) or
+               (self.max_bytes and self.size > self.max_bytes)):
+            old_key, (old_data, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+    
+    def discard(self, key):
+        """
+        Remove an entry from the cache, if present.
+        
+        Parameters:
+            key - The entry's key.
+        """
+        entry = self._entries.pop(key, None)
+        
+        if entry is not None:
+            self.size -= entry[1]
+    
+    def clear(self):
+        """
+        Remove every entry from the cache. Counters are left intact.
+        """
+        self._entries.clear()
+        self.size = 0
+    
+    def stats(self):
+        """
+        Return a dictionary describing the cache's usage.
+        """
+        lookups = self.hits + self.misses
+        
+        return {
+            "items": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+###############################################################################
+# Writer Class
+###############################################################################
+
+class Writer(threading.Thread):
+    """
+    A thread which owns a store's write connection and executes queued
+    requests against it, in order.
+    
+    Each request is a function which is called with the writer's
+    connection followed by the request's arguments.
+    """
+    def __init__(self, filename, synchronous="FULL"):
+        """
+        Initialise the writer. The connection is opened once the thread
+        is started.
+        
+        Parameters:
+            filename - The database file.
+            synchronous - The connection's synchronous setting. Defaults
+                to "FULL".
+        """
+        threading.Thread.__init__(self, name="store-writer")
+        self.daemon = True
+        
+        self.filename = filename
+        self.synchronous = synchronous
+        self.queue = Queue.Queue()
+    
+    def run(self):
+        con = sqlite3.connect(self.filename)
+        con.execute("PRAGMA synchronous=%s" % self.synchronous)
+        
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            
+            function, args = request
+            try:
+                function(con, *args)
+            except Exception:
+                log.exception("Exception raised by store writer.")
+        
+        con.close()
+    
+    def submit(self, function, *args):
+        """
+        Queue a request.
+        
+        Parameters:
+            function - The function to call.
+            *args - Arguments to pass to the function after the
+                connection.
+        """
+        self.queue.put((function, args))
+    
+    def stop(self):
+        """
+        Execute any queued requests, then stop the thread and wait for
+        it to finish.
+        """
+        self.queue.put(None)
+        self.join()
+
+
+###############################################################################
+# Shard Class
+###############################################################################
+
+class Shard(object):
+    """
+    One of the SQLite databases backing a store, along with its
+    connection and, for threaded stores, its writer.
+    """
+    def __init__(self, filename):
+        """
+        Initialise the shard. The database is opened by the store.
+        
+        Parameters:
+            filename - The database file.
+        """
+        self.filename = filename
+        self.con = None
+        self.writer = None
+        self.dirty = False # Are there uncommitted writes?
+        
+        self.inflight = [] # (sequence, pending) handed to the writer.
+        self.sequence = 0 # The sequence number of the last hand-over.
+        self.committed = 0 # The last sequence number committed.
+
+
 ###############################################################################
 # Store Class
 ###############################################################################
 
 class Store(UserDict.DictMixin):
     """
-    A subclass of UserDict.DictMixin which stores JSON-serialised data
-    in an SQLite backend.
+    A subclass of UserDict.DictMixin which stores serialised data in an
+    SQLite backend.
     
     This class is similar to Python's Shelf class except that it uses
-    JSON to serialise data, maps data to a string key and stores the key
-    -value pair in an SQLite database. The SQLite database is
-    automatically commited whenever it is modified.
+    JSON (or another codec, see mud.codec) to serialise data, maps data
+    to a string key and stores the key-value pair in an SQLite database.
+    The SQLite database is automatically commited whenever it is
+    modified.
+    
+    If the store is connected with a cache, reads are served from an
+    in-process LRU cache and writes are buffered in memory until the
+    next call to commit(), at which point they are written to the
+    database in a single batch. Values returned from, and given to, a
+    cached store are shared with the cache and should not be modified
+    in place.
+    
+    Fields of stored dictionaries may be indexed with add_index() and
+    queried with find().
+    
+    If the store is connected in threaded mode, writes and commits are
+    handed to a Writer thread with its own connection, so that slow
+    disk I/O does not block the engine. Writes stay buffered, and so
+    readable, until the writer has committed them. Queries and scans
+    overlay the buffered writes on what the database holds, rather than
+    waiting for the writer. Use barrier() to wait until everything has
+    been persisted.
+    
+    A store may be sharded across several database files, with keys
+    routed to a file by prefix or by hash. Each file is committed
+    independently and queries span every relevant file. Routing is
+    invisible to users of the store.
     """
     def __init__(self):
         self.connected = False
-        self.con = None
+        self.con = None # The default shard's connection.
         self.dirty = False # Do we need to commit?
+        self.cache = None
+        self.buffered = False # Are writes buffered until commit?
+        self._pending = {} # key -> (codec, serialised, data), or None.
+        self.indexes = {} # field -> list of key prefixes maintained.
+        self._declared = {} # field -> list of key prefixes from add_index().
+        
+        self.fetch_size = 500 # Rows fetched at a time when iterating.
+        
+        self.shards = []
+        self._routes = [] # (prefix, shard), longest prefix first.
+        self._hashed = False
+        
+        self.codec = "json"
+        self.compress_threshold = 0
+        
+        self.durability = "safe"
+        self.group_interval = 0
+        self.group_writes = 0
+        self._writes = 0 # Writes since the last commit.
+        self._last_commit = 0.0
+        
+        self.commits = 0
+        self.commit_time = 0.0
+        self.commit_max = 0.0
+        self.commit_last = 0.0
     
     ##### Control #############################################################
     
-    def connect(self, filename=":memory:"):
+    def connect(self, filename=":memory:", cache_size=0, cache_bytes=0,
+                durability="safe", group_interval=1000, group_writes=1000,
+                threaded=False, codec="json", compress_threshold=0,
+                shards=None):
         """
         Connect the store to a database file.
         
         If the core is already connected, its current connection will be
         closed. If no filename is specified, a temporary in-memory
         database will be created. 
+        
+        Parameters:
+            filename - The database file. Defaults to ":memory:".
+            cache_size - The maximum number of records to cache. Zero
+                means no limit. Defaults to 0.
+            cache_bytes - The maximum size, in bytes of serialised data,
+                of the cached records. Zero means no limit. Defaults to
+                0.
+            durability - One of "safe", "wal" or "group". Defaults to
+                "safe".
+            group_interval - In "group" mode, the longest time in
+                milliseconds to leave changes uncommitted. Defaults to
+                1000.
+            group_writes - In "group" mode, the largest number of writes
+                to leave uncommitted. Defaults to 1000.
+            threaded - If True, writes and commits are made by a
+                background thread. Requires a database file. Defaults to
+                False.
+            codec - The name of the codec new rows are written with.
+                Rows written with other codecs remain readable. Defaults
+                to "json".
+            compress_threshold - If non-zero, serialised data of at
+                least this many bytes is zlib-compressed. Defaults to 0.
+            shards - Either a number of files to spread keys across by
+                hash, or a dictionary mapping key prefixes to the files
+                that hold them, with every other key held in filename.
+                Hashed shards are named after filename, so "world.db"
+                with 4 shards becomes "world.0.db" to "world.3.db".
+                Defaults to None, which holds every key in filename.
+        
+        The cache is only enabled if cache_size or cache_bytes is given.
+        Threaded stores always use write-ahead logging, so that reads
+        do not block on the writer; their durability bounds are
+        otherwise unchanged.
+        
+        The durability modes trade crash safety for commit latency:
+        
+            safe - SQLite's default rollback journal with a full fsync
+                on every commit. A crash loses at most the changes made
+                since the last commit() call.
+            wal - Write-ahead logging with synchronous=NORMAL. Commits
+                do not fsync, so an application crash loses at most the
+                changes since the last commit() call, while a power
+                failure or OS crash may also roll back commits made
+                since the last WAL checkpoint. The database is never
+                left corrupt.
+            group - As "wal", but commit() only commits once
+                group_interval milliseconds have passed or group_writes
+                writes have been made since the previous commit,
+                whichever comes first. A crash loses at most that many
+                milliseconds or writes in addition to the "wal" bound.
+        
+        Each shard commits independently, so with several shards a
+        crash may leave some of one commit() call's changes persisted
+        and others lost.
+        
+        The latency of each commit is recorded; see commit_stats().
         """
+        if isinstance(shards, dict):
+            routes = sorted(shards.iteritems(), key=lambda r: -len(r[0]))
+            filenames = [filename] + [f for p, f in routes if f != filename]
+            filenames = sorted(set(filenames), key=filenames.index)
+        elif shards:
+            root, ext = os.path.splitext(filename)
+            if filename == ":memory:":
+                filenames = [filename] * shards
+            else:
+                filenames = ["%s.%d%s" % (root, i, ext) for i in xrange(shards)]
+        else:
+            filenames = [filename]
+        
+        if not durability in DURABILITY_MODES:
+            raise ValueError("Unknown durability mode '%s'." % durability)
+        elif threaded and ":memory:" in filenames:
+            raise ValueError("Threaded stores require a database file.")
+        elif not codec in codecs:
+            raise ValueError("Unknown codec '%s'." % codec)
+        
         if self.connected:
             self.close()
         
-        if filename == ":memory:" or not os.path.exists(filename):
-            new_store = True
+        self.shards = [Shard(f) for f in filenames]
+        self._hashed = bool(shards) and not isinstance(shards, dict)
+        
+        if isinstance(shards, dict):
+            self._routes = [(prefix, self.shards[filenames.index(f)])
+                            for prefix, f in routes]
         else:
-            new_store = False
+            self._routes = []
+        
+        if cache_size or cache_bytes:
+            self.cache = Cache(cache_size, cache_bytes)
+        
+        self.buffered = self.cache is not None or threaded
+        self.codec = codec
+        self.compress_threshold = compress_threshold
         
-        self.con = sqlite3.connect(filename)
+        self.durability = durability
+        self.group_interval = group_interval
+        self.group_writes = group_writes
+        self._writes = 0
+        self._last_commit = time.time()
+        
+        self.commits = 0
+        self.commit_time = 0.0
+        self.commit_max = 0.0
+        self.commit_last = 0.0
+        
+        # Every index declared with add_index(), or recorded in any
+        # shard as built, is maintained on every write.
+        self.indexes = dict((field, list(prefixes)) for field, prefixes
+                            in self._declared.iteritems())
+        
+        for shard in self.shards:
+            self._open(shard, threaded)
+        
+        for shard in self.shards:
+            for field, prefixes in self.indexes.iteritems():
+                for prefix in prefixes:
+                    self._run(shard, self._build_index, field, prefix)
+        
+        self.con = self.shards[0].con
         self.connected = True
         
-        if new_store:
-            cur = self.con.cursor()
-            cur.execute(SCHEMA)
+        if threaded:
+            self.barrier() # Make the indexes visible to threaded readers.
         
-        publisher.subscribe("pants.engine.stop", self.close)
+        publisher.subscribe("pants.engine.stop", self.close, weak=True)
     
     def commit(self, override=False):
         """
         Commit any unsaved changes to the store.
         
+        In "group" durability mode, the commit is deferred until enough
+        time has passed or enough writes have been made since the
+        previous one.
+        
         Parameters:
             override - If True, store will be committed even if it is
-                not flagged as dirty. Defaults to False.
+                not flagged as dirty or group commit would defer it.
+                Defaults to False.
         """
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         elif not override and not self.dirty:
             return
         
-        self.con.commit()
+        start = time.time()
+        
+        if (not override and self.durability == "group" and
+                self._writes < self.group_writes and
+                (start - self._last_commit) * 1000 < self.group_interval):
+            return
+        
+        self.flush()
+        
+        for shard in self.shards:
+            if shard.dirty:
+                self._run(shard, self._commit, shard, shard.sequence)
+                shard.dirty = False
+        
         self.dirty = False
+        self._writes = 0
+        self._last_commit = time.time()
+    
+    def barrier(self, timeout=None):
+        """
+        Commit any unsaved changes and block until they have been
+        persisted. Returns False if the timeout expired first.
+        
+        Parameters:
+            timeout - The longest time, in seconds, to wait for a
+                threaded store's writers. If None, waits indefinitely.
+                Defaults to None.
+        """
+        self.commit(override=True)
+        
+        events = []
+        for shard in self.shards:
+            if shard.writer is not None:
+                event = threading.Event()
+                shard.writer.submit(lambda con, event=event: event.set())
+                events.append(event)
+        
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        for event in events:
+            if timeout is None:
+                event.wait()
+            else:
+                event.wait(max(deadline - time.time(), 0))
+        
+        return all(event.is_set() for event in events)
+    
+    def commit_stats(self):
+        """
+        Return a dictionary describing the store's commit latency, in
+        seconds.
+        """
+        return {
+            "durability": self.durability,
+            "commits": self.commits,
+            "total": self.commit_time,
+            "average": self.commit_time / self.commits if self.commits else 0.0,
+            "max": self.commit_max,
+            "last": self.commit_last,
+            }
+    
+    def flush(self):
+        """
+        Write any buffered changes to the database without committing
+        them.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        elif not self._pending:
+            return
+        
+        batches = {} # shard -> (pending, writes, deletes)
+        for key, entry in self._pending.iteritems():
+            shard = self._shard(key)
+            if not shard in batches:
+                batches[shard] = ({}, [], [])
+            
+            pending, writes, deletes = batches[shard]
+            pending[key] = entry
+            
+            if entry is None:
+                deletes.append(key)
+            else:
+                writes.append((key,) + entry)
+        
+        for shard, (pending, writes, deletes) in batches.iteritems():
+            if shard.writer is not None:
+                # Keep the entries readable until the writer commits them.
+                shard.sequence += 1
+                shard.inflight.append((shard.sequence, pending))
+            
+            self._run(shard, self._delete_many, deletes)
+            self._run(shard, self._write_many, writes)
+            shard.dirty = True
+        
+        self._pending = {}
     
     def close(self):
         """
-        Close the store's database connection.
+        Close the store's database connection. Publishes
+        "mud.store.close", with the store, just before the final commit.
         """
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
@@ -125,11 +683,34 @@ class Store(UserDict.DictMixin):
             # call to produce a rather baffling AttributeError which we
             # can safely ignore.
             pass
+        except ValueError:
+            # The subscription is weak, so when close() is called from
+            # __del__ it has already been pruned.
+            pass
+        
+        try:
+            # Let anything holding unsaved changes write them now.
+            publisher.publish("mud.store.close", self)
+        except AttributeError:
+            pass # The publisher may be gone, as above.
+        
+        self.commit(override=True)
         
-        self.commit()
-        self.con.close()
+        for shard in self.shards:
+            if shard.writer is not None:
+                shard.writer.stop()
+                shard.writer = None
+                shard.inflight = []
+            
+            shard.con.close()
+            shard.con = None
+        
+        self.shards = []
+        self._routes = []
         self.con = None
         self.connected = False
+        self.cache = None
+        self.buffered = False
     
     ##### Magic Methods #######################################################
     
@@ -143,70 +724,668 @@ class Store(UserDict.DictMixin):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        return len(self.keys())
+        buffered = self._snapshot(self.shards)
+        groups = self._group(buffered)
+        
+        # Buffered writes add keys, and deletes remove them, unless the
+        # database already agrees.
+        count = sum(1 for entry in buffered.itervalues() if entry)
+        
+        for shard in self.shards:
+            keys = groups.get(shard)
+            cur = shard.con.cursor()
+            
+            if keys:
+                # Count in a single read transaction, so that a commit
+                # made in between cannot be counted twice or missed.
+                cur.execute("BEGIN")
+            
+            try:
+                cur.execute("SELECT COUNT(*) FROM pants_data")
+                count += cur.fetchone()[0]
+                
+                if keys:
+                    count -= sum(1 for key in self._existing(shard, keys))
+            finally:
+                if keys:
+                    shard.con.commit()
+        
+        return count
     
-    def __contains__(self, pattern):
+    def __contains__(self, key):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        try:
-            self.select(pattern).next()
-        except StopIteration:
-            return False # No keys? Return False.
+        if self.cache is not None and key in self.cache:
+            return True
+        elif self.buffered:
+            try:
+                return self._buffered(key) is not None
+            except KeyError:
+                pass
+        
+        sql = "SELECT 1 FROM pants_data WHERE key=?"
+        cur = self._shard(key).con.cursor()
+        cur.execute(sql, (key,))
         
-        return True # One or more keys? Return True.
+        return cur.fetchone() is not None
     
     def __getitem__(self, key):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        # TODO Improve this method.
-        sql = "SELECT data FROM pants_data WHERE key=?"
-        cur = self.con.cursor()
-        cur.execute(sql, (key,))
-        row = cur.fetchone() # Keys are unique, there can only be one row.
+        if not self.buffered:
+            return decode(*self._fetch(key))
         
-        if not row: # Row is None if there are no rows.
-            # TODO Log this?
-            raise KeyError(repr(key))
+        if self.cache is not None:
+            try:
+                return self.cache.get(key)
+            except KeyError:
+                pass
         
-        raw_data, = row
+        try:
+            entry = self._buffered(key)
+        except KeyError:
+            tag, raw_data = self._fetch(key)
+            data = decode(tag, raw_data)
+        else:
+            if entry is None: # Deleted, but not yet written.
+                raise KeyError(repr(key))
+            tag, raw_data, data = entry
         
-        return json.loads(raw_data)
+        if self.cache is not None:
+            self.cache.put(key, data, len(raw_data))
+        
+        return data
     
     def __setitem__(self, key, data):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        raw_data = json.dumps(data)
-        
-        sql = "SELECT * FROM pants_data WHERE key=?"
-        cur = self.con.cursor()
-        cur.execute(sql, (key,))
-        # Hacky.
-        row = cur.fetchone() # Keys are unique, there can only be one.
+        tag, raw_data = encode(data, self.codec, self.compress_threshold)
         
-        if not row: # Row is None if there are no rows.
-            sql = "INSERT INTO pants_data (key, data) VALUES (?, ?)"
-            cur.execute(sql, (key, raw_data))
+        if self.buffered:
+            if self.cache is not None:
+                self.cache.put(key, data, len(raw_data))
+            self._pending[key] = (tag, raw_data, data)
         else:
-            sql = "UPDATE pants_data SET data=? WHERE key=?"
-            cur.execute(sql, (raw_data, key))
+            shard = self._shard(key)
+            self._write_many(shard.con, [(key, tag, raw_data, data)])
+            shard.dirty = True
         
-        self.dirty = True # We need to commit.
+        self._modified()
     
     def __delitem__(self, key):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        sql = "DELETE FROM pants_data WHERE key=?"
-        cur = self.con.cursor()
-        cur.execute(sql, (key,))
+        if self.buffered:
+            if self.cache is not None:
+                self.cache.discard(key)
+            self._pending[key] = None
+        else:
+            shard = self._shard(key)
+            self._delete_many(shard.con, [key])
+            shard.dirty = True
+        
+        self._modified()
     
     def __iter__(self):
         for key in self.iterkeys():
             yield key
     
+    ##### Internal Methods ####################################################
+    
+    def _open(self, shard, threaded):
+        """
+        Open a shard's database, creating or upgrading its schema, and
+        add the indexes recorded in it to those the store maintains.
+        
+        Parameters:
+            shard - The shard to open.
+            threaded - If True, the shard's connection is made
+                read-only and a writer is started for it.
+        """
+        filename = shard.filename
+        
+        if filename == ":memory:" or not os.path.exists(filename):
+            new_store = True
+        else:
+            new_store = False
+        
+        shard.con = sqlite3.connect(filename)
+        
+        if self.durability == "safe":
+            synchronous = "FULL"
+        else:
+            synchronous = "NORMAL"
+        
+        cur = shard.con.cursor()
+        
+        if self.durability != "safe" or threaded:
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=%s" % synchronous)
+        
+        if new_store:
+            cur.execute(SCHEMA)
+        else:
+            cur.execute("PRAGMA table_info(pants_data)")
+            if not "codec" in [row[1] for row in cur.fetchall()]:
+                # Created before codecs were supported; every row is JSON.
+                cur.execute("ALTER TABLE pants_data ADD COLUMN codec TEXT")
+        
+        shard.con.executescript(INDEX_SCHEMA)
+        
+        # An index recorded as built must be kept up to date, even if
+        # this process never declares it, or it would go stale.
+        cur.execute("SELECT field, prefix FROM pants_index_fields")
+        for field, prefix in cur.fetchall():
+            prefixes = self.indexes.setdefault(field, [])
+            if not prefix in prefixes:
+                prefixes.append(prefix)
+        
+        if threaded:
+            cur.execute("PRAGMA query_only=ON")
+            shard.writer = Writer(filename, synchronous)
+            shard.writer.start()
+    
+    def _shard(self, key):
+        """
+        Return the shard that holds a key.
+        
+        Parameters:
+            key - The key.
+        """
+        if len(self.shards) == 1:
+            return self.shards[0]
+        
+        if self._hashed:
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            return self.shards[(zlib.crc32(key) & 0xffffffff) % len(self.shards)]
+        
+        for prefix, shard in self._routes:
+            if key.startswith(prefix):
+                return shard
+        
+        return self.shards[0]
+    
+    def _shards_for(self, prefix):
+        """
+        Return a list of the shards that may hold keys beginning with
+        the given prefix.
+        
+        Parameters:
+            prefix - The key prefix.
+        """
+        if len(self.shards) == 1 or self._hashed:
+            return self.shards
+        
+        shards = [self._shard(prefix)]
+        for route, shard in self._routes:
+            if route.startswith(prefix) and not shard in shards:
+                shards.append(shard)
+        
+        return shards
+    
+    def _run(self, shard, function, *args):
+        """
+        Call a function with a shard's write connection and the given
+        arguments, either immediately or, for threaded stores, on the
+        shard's writer thread.
+        
+        Parameters:
+            shard - The shard to write to.
+            function - The function to call.
+            *args - Arguments to pass to the function after the
+                connection.
+        """
+        if shard.writer is None:
+            function(shard.con, *args)
+        else:
+            shard.writer.submit(function, *args)
+    
+    def _commit(self, con, shard, sequence):
+        """
+        Commit a connection and record the commit's latency.
+        
+        Parameters:
+            con - The connection to commit.
+            shard - The shard the connection belongs to.
+            sequence - The sequence number of the last hand-over to the
+                shard's writer that this commit covers.
+        """
+        start = time.time()
+        con.commit()
+        latency = time.time() - start
+        
+        shard.committed = sequence
+        
+        self.commits += 1
+        self.commit_time += latency
+        self.commit_last = latency
+        self.commit_max = max(self.commit_max, latency)
+    
+    def _buffered(self, key):
+        """
+        Return the buffered entry for a key: a (codec, serialised data,
+        data) tuple, or None if the key has been deleted. Raises KeyError if
+        nothing is buffered for the key.
+        
+        Parameters:
+            key - The key to look up.
+        """
+        if key in self._pending:
+            return self._pending[key]
+        
+        shard = self._shard(key)
+        self._prune(shard)
+        
+        for sequence, pending in reversed(shard.inflight):
+            if key in pending:
+                return pending[key]
+        
+        raise KeyError(repr(key))
+    
+    def _prune(self, shard):
+        """
+        Forget any entries handed to a shard's writer which it has since
+        committed.
+        
+        Parameters:
+            shard - The shard to prune.
+        """
+        while shard.inflight and shard.inflight[0][0] <= shard.committed:
+            del shard.inflight[0]
+    
+    def _snapshot(self, shards):
+        """
+        Return a dictionary mapping each key with a write that the read
+        connections of the given shards cannot see yet to its buffered
+        entry, as returned by _buffered(). Stores without writers flush
+        their buffered writes instead, and return an empty dictionary.
+        
+        Parameters:
+            shards - The shards about to be queried.
+        """
+        if self.shards[0].writer is None:
+            self.flush()
+            return {}
+        
+        buffered = {}
+        for shard in shards:
+            self._prune(shard)
+            for sequence, pending in shard.inflight:
+                buffered.update(pending)
+        
+        for key, entry in self._pending.iteritems():
+            if self._shard(key) in shards:
+                buffered[key] = entry
+        
+        # Key the entries as the database returns keys, as text.
+        for key in [key for key in buffered if isinstance(key, str)]:
+            buffered[key.decode("utf-8")] = buffered.pop(key)
+        
+        return buffered
+    
+    def _existing(self, shard, keys):
+        """
+        Return an iterator over those of the given keys that exist in a
+        shard's database, ignoring any buffered writes.
+        
+        Parameters:
+            shard - The shard that holds the keys.
+            keys - A list of keys.
+        """
+        cur = shard.con.cursor()
+        
+        for i in xrange(0, len(keys), MAX_VARIABLES):
+            chunk = keys[i:i + MAX_VARIABLES]
+            sql = ("SELECT key FROM pants_data WHERE key IN (%s)" %
+                   ", ".join("?" * len(chunk)))
+            cur.execute(sql, chunk)
+            
+            for row in cur.fetchall():
+                yield row[0]
+    
+    def _select(self, sql, parameters=(), shards=None, ordered=False,
+                fetch_size=None, overlay=None):
+        """
+        Return an iterator over the rows produced by running a query on
+        each shard, fetched in batches.
+        
+        Buffered writes that the read connections cannot see yet are
+        overlaid on the results: rows for keys that have since been
+        written or deleted are dropped, and the row overlay returns for
+        each buffered write is added.
+        
+        Parameters:
+            sql - The query. Its first column must be the key.
+            parameters - The query's parameters. Defaults to ().
+            shards - The shards to query. If None, every shard is
+                queried. Defaults to None.
+            ordered - If True, the query returns rows in key order and
+                the shards' rows will be merged in key order. Defaults
+                to False.
+            fetch_size - The number of rows to fetch at a time. If None,
+                the store's fetch_size is used. Defaults to None.
+            overlay - A function which, given a buffered key and its
+                (codec, serialised data, data) entry, returns the row
+                the query would produce for it, or None if the query
+                would not match it. If None, buffered writes produce no
+                rows. Defaults to None.
+        """
+        if shards is None:
+            shards = self.shards
+        
+        buffered = self._snapshot(shards)
+        
+        results = [self._select_shard(shard, sql, parameters, fetch_size)
+                   for shard in shards]
+        
+        if len(results) == 1:
+            rows = results[0]
+        elif ordered:
+            rows = heapq.merge(*results) # Keys are unique across shards.
+        else:
+            rows = itertools.chain(*results)
+        
+        if buffered:
+            extra = []
+            if overlay is not None:
+                for key, entry in buffered.iteritems():
+                    if entry is not None:
+                        row = overlay(key, entry)
+                        if row is not None:
+                            extra.append(row)
+            
+            rows = (row for row in rows if not row[0] in buffered)
+            if ordered:
+                extra.sort()
+                rows = heapq.merge(rows, extra)
+            else:
+                rows = itertools.chain(rows, extra)
+        
+        for row in rows:
+            yield row
+    
+    def _select_shard(self, shard, sql, parameters, fetch_size):
+        """
+        Return an iterator over the rows produced by a query on a
+        single shard, fetched in batches.
+        
+        Parameters:
+            shard - The shard to query.
+            sql - The query.
+            parameters - The query's parameters.
+            fetch_size - The number of rows to fetch at a time. If None,
+                the store's fetch_size is used.
+        """
+        cur = shard.con.cursor()
+        cur.execute(sql, parameters)
+        
+        rows = cur.fetchmany(fetch_size or self.fetch_size)
+        while rows:
+            for row in rows:
+                yield row
+            rows = cur.fetchmany(fetch_size or self.fetch_size)
+    
+    def _select_keys(self, sql, parameters=(), shards=None, ordered=False,
+                     include=None):
+        """
+        Return an iterator over the keys produced by a query.
+        
+        Parameters:
+            sql - A query selecting a single key column.
+            parameters - The query's parameters. Defaults to ().
+            shards - The shards to query. If None, every shard is
+                queried. Defaults to None.
+            ordered - If True, keys are returned in order. Defaults to
+                False.
+            include - A function which, given a buffered key and its
+                (codec, serialised data, data) entry, returns whether
+                the query would match it. If None, every buffered key is
+                included. Defaults to None.
+        """
+        if include is None:
+            overlay = lambda key, entry: (key,)
+        else:
+            overlay = lambda key, entry: (key,) if include(key, entry) else None
+        
+        for row in self._select(sql, parameters, shards, ordered,
+                                overlay=overlay):
+            yield row[0]
+    
+    def _modified(self, count=1):
+        """
+        Flag the store as needing to be committed.
+        
+        Parameters:
+            count - The number of writes made. Defaults to 1.
+        """
+        self.dirty = True # We need to commit.
+        self._writes += count
+    
+    def _fetch(self, key):
+        """
+        Return a (codec, serialised data) pair for a key straight from
+        the database. Raises KeyError if the key does not exist.
+        
+        Parameters:
+            key - The key to look up.
+        """
+        sql = "SELECT codec, data FROM pants_data WHERE key=?"
+        cur = self._shard(key).con.cursor()
+        cur.execute(sql, (key,))
+        row = cur.fetchone() # Keys are unique, there can only be one row.
+        
+        if not row: # Row is None if there are no rows.
+            # TODO Log this?
+            raise KeyError(repr(key))
+        
+        return row
+    
+    def _fetch_many(self, keys):
+        """
+        Return an iterator over (key, codec, serialised data) tuples for
+        those of the given keys that exist in the database.
+        
+        Parameters:
+            keys - A list of keys to look up.
+        """
+        for shard, keys in self._group(keys).iteritems():
+            cur = shard.con.cursor()
+            
+            for i in xrange(0, len(keys), MAX_VARIABLES):
+                chunk = keys[i:i + MAX_VARIABLES]
+                sql = ("SELECT key, codec, data FROM pants_data "
+                       "WHERE key IN (%s)" % ", ".join("?" * len(chunk)))
+                cur.execute(sql, chunk)
+                
+                for row in cur.fetchall():
+                    yield row
+    
+    def _group(self, items):
+        """
+        Return a dictionary mapping shards to the list of items that
+        belong to each.
+        
+        Parameters:
+            items - An iterable of keys, or of tuples whose first
+                element is a key.
+        """
+        groups = {}
+        
+        if len(self.shards) == 1:
+            items = list(items)
+            if items:
+                groups[self.shards[0]] = items
+            return groups
+        
+        for item in items:
+            if isinstance(item, basestring):
+                shard = self._shard(item)
+            else:
+                shard = self._shard(item[0])
+            groups.setdefault(shard, []).append(item)
+        
+        return groups
+    
+    def _write_many(self, con, rows):
+        """
+        Write a list of rows to the database, updating any indexes.
+        
+        Parameters:
+            con - The connection to write with.
+            rows - A list of (key, codec, serialised data, data) tuples.
+        """
+        if not rows:
+            return
+        
+        cur = con.cursor()
+        cur.executemany(UPSERT, [(key, raw_data, tag)
+                                 for key, tag, raw_data, data in rows])
+        
+        if self.indexes:
+            self._index_many(con, rows)
+    
+    def _delete_many(self, con, keys):
+        """
+        Delete a list of keys from the database.
+        
+        Parameters:
+            con - The connection to write with.
+            keys - A list of keys to delete.
+        """
+        if not keys:
+            return
+        
+        parameters = [(key,) for key in keys]
+        
+        sql = "DELETE FROM pants_data WHERE key=?"
+        cur = con.cursor()
+        cur.executemany(sql, parameters)
+        
+        if self.indexes:
+            sql = "DELETE FROM pants_index WHERE key=?"
+            cur.executemany(sql, parameters)
+    
+    def _index_many(self, con, rows):
+        """
+        Update the index entries of a list of rows.
+        
+        Parameters:
+            con - The connection to write with.
+            rows - A list of (key, codec, serialised data, data) tuples.
+        """
+        deletes = []
+        inserts = []
+        
+        for key, tag, raw_data, data in rows:
+            for field, prefixes in self.indexes.iteritems():
+                for prefix in prefixes:
+                    if key.startswith(prefix):
+                        break
+                else:
+                    continue
+                
+                deletes.append((field, key))
+                
+                value = index_value(data, field)
+                if value is not None:
+                    inserts.append((field, value, key))
+        
+        cur = con.cursor()
+        
+        sql = "DELETE FROM pants_index WHERE field=? AND key=?"
+        cur.executemany(sql, deletes)
+        
+        sql = "INSERT INTO pants_index (field, value, key) VALUES (?, ?, ?)"
+        cur.executemany(sql, inserts)
+    
+    def _reencode(self, con, batch_size):
+        """
+        Re-encode every row in the database with the store's codec,
+        committing after each batch.
+        
+        Parameters:
+            con - The connection to write with.
+            batch_size - The number of rows to read at a time.
+        """
+        cur = con.cursor()
+        last = None
+        count = 0
+        
+        while True:
+            if last is None:
+                sql = "SELECT key, codec, data FROM pants_data ORDER BY key LIMIT ?"
+                cur.execute(sql, (batch_size,))
+            else:
+                sql = ("SELECT key, codec, data FROM pants_data WHERE key > ? "
+                       "ORDER BY key LIMIT ?")
+                cur.execute(sql, (last, batch_size))
+            
+            rows = cur.fetchall()
+            if not rows:
+                break
+            
+            updates = []
+            for key, tag, raw_data in rows:
+                data = decode(tag, raw_data)
+                new_tag, new_raw_data = encode(data, self.codec,
+                                               self.compress_threshold)
+                if new_tag != (tag or "json"):
+                    updates.append((new_raw_data, new_tag, key))
+            
+            sql = "UPDATE pants_data SET data=?, codec=? WHERE key=?"
+            cur.executemany(sql, updates)
+            con.commit()
+            
+            count += len(updates)
+            last = rows[-1][0]
+        
+        log.info("Re-encoded %d rows as '%s'." % (count, self.codec))
+    
+    def _build_index(self, con, field, prefix):
+        """
+        Index a field of every existing row whose key begins with the
+        given prefix, unless that has already been done.
+        
+        Parameters:
+            con - The connection to write with.
+            field - The name of the field.
+            prefix - The key prefix.
+        """
+        sql = "SELECT 1 FROM pants_index_fields WHERE field=? AND prefix=?"
+        cur = con.cursor()
+        cur.execute(sql, (field, prefix))
+        
+        if cur.fetchone() is not None:
+            return # Already built, and kept up to date since.
+        
+        start, end = prefix_range(prefix)
+        if end is None:
+            sql = "SELECT key, codec, data FROM pants_data WHERE key >= ?"
+            cur.execute(sql, (start,))
+        else:
+            sql = ("SELECT key, codec, data FROM pants_data "
+                   "WHERE key >= ? AND key < ?")
+            cur.execute(sql, (start, end))
+        
+        inserts = []
+        for key, tag, raw_data in cur.fetchall():
+            value = index_value(decode(tag, raw_data), field)
+            if value is not None:
+                inserts.append((field, value, key))
+        
+        sql = "INSERT OR IGNORE INTO pants_index (field, value, key) VALUES (?, ?, ?)"
+        cur.executemany(sql, inserts)
+        
+        sql = "INSERT INTO pants_index_fields (field, prefix) VALUES (?, ?)"
+        cur.execute(sql, (field, prefix))
+        
+        con.commit()
+    
     ##### Interface ###########################################################
     
     def has_key(self, key):
@@ -231,6 +1410,223 @@ class Store(UserDict.DictMixin):
         except KeyError:
             return default
     
+    def get_many(self, keys):
+        """
+        Return a dictionary mapping each of the given keys that exists
+        in the store to its value. Keys that do not exist are left out.
+        
+        Any keys that are not cached are read with as few queries as
+        possible.
+        
+        Parameters:
+            keys - An iterable of keys.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        results = {}
+        missing = []
+        
+        for key in keys:
+            if key in results:
+                continue
+            
+            if self.cache is not None:
+                try:
+                    results[key] = self.cache.get(key)
+                    continue
+                except KeyError:
+                    pass
+            
+            if self.buffered:
+                try:
+                    entry = self._buffered(key)
+                except KeyError:
+                    pass
+                else:
+                    if entry is not None:
+                        tag, raw_data, data = entry
+                        if self.cache is not None:
+                            self.cache.put(key, data, len(raw_data))
+                        results[key] = data
+                    continue
+            
+            missing.append(key)
+        
+        for key, tag, raw_data in self._fetch_many(missing):
+            data = decode(tag, raw_data)
+            if self.cache is not None:
+                self.cache.put(key, data, len(raw_data))
+            results[key] = data
+        
+        return results
+    
+    def set_many(self, items):
+        """
+        Store many values at once. Uncached stores write every value
+        with a single batched statement.
+        
+        Parameters:
+            items - A dictionary, or an iterable of (key, value) pairs.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+        
+        count = 0
+        rows = OrderedDict() # The last value given for a key wins.
+        for key, data in items:
+            tag, raw_data = encode(data, self.codec, self.compress_threshold)
+            count += 1
+            
+            if self.buffered:
+                if self.cache is not None:
+                    self.cache.put(key, data, len(raw_data))
+                self._pending[key] = (tag, raw_data, data)
+            else:
+                rows[key] = (key, tag, raw_data, data)
+        
+        for shard, rows in self._group(rows.values()).iteritems():
+            self._write_many(shard.con, rows)
+            shard.dirty = True
+        
+        self._modified(count)
+    
+    def delete_many(self, keys):
+        """
+        Delete many keys at once. Keys that do not exist are ignored.
+        
+        Parameters:
+            keys - An iterable of keys.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        keys = list(keys)
+        
+        if self.buffered:
+            for key in keys:
+                if self.cache is not None:
+                    self.cache.discard(key)
+                self._pending[key] = None
+        else:
+            for shard, keys in self._group(keys).iteritems():
+                self._delete_many(shard.con, keys)
+                shard.dirty = True
+        
+        self._modified(len(keys))
+    
+    def reencode(self, codec=None, compress_threshold=None, batch_size=1000):
+        """
+        Re-encode the whole database in place, so that every row uses
+        the given codec and compression settings, which also become the
+        settings for future writes. Rows are streamed and committed in
+        batches, so memory use is bounded by the batch size.
+        
+        Parameters:
+            codec - The name of the codec to use. If None, the store's
+                current codec is used. Defaults to None.
+            compress_threshold - The compression threshold to use. If
+                None, the store's current threshold is used. Defaults to
+                None.
+            batch_size - The number of rows to re-encode per commit.
+                Defaults to 1000.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        elif codec is not None and not codec in codecs:
+            raise ValueError("Unknown codec '%s'." % codec)
+        
+        self.barrier()
+        
+        if codec is not None:
+            self.codec = codec
+        if compress_threshold is not None:
+            self.compress_threshold = compress_threshold
+        
+        for shard in self.shards:
+            self._run(shard, self._reencode, batch_size)
+        
+        self.barrier()
+    
+    def add_index(self, field, prefix=""):
+        """
+        Index a field of the dictionaries stored under keys beginning
+        with the given prefix, so they can be queried with find().
+        Only string and numeric field values are indexed.
+        
+        Indexes may be declared before the store is connected, for
+        example alongside the Object subclass whose data they cover.
+        The first time an index is used with a database, existing rows
+        are indexed. From then on, the index is kept up to date as rows
+        are written, by this and any later connection to the database,
+        whether or not it declares the index.
+        
+        Parameters:
+            field - The name of the field to index.
+            prefix - The key prefix, such as "mob:". Defaults to "",
+                which covers every key.
+        """
+        declared = self._declared.setdefault(field, [])
+        if not prefix in declared:
+            declared.append(prefix)
+        
+        prefixes = self.indexes.setdefault(field, [])
+        if prefix in prefixes:
+            return
+        
+        prefixes.append(prefix)
+        
+        if self.connected:
+            self.flush()
+            
+            for shard in self.shards:
+                self._run(shard, self._build_index, field, prefix)
+            
+            self.barrier() # Make the index visible to threaded readers.
+    
+    def find(self, **criteria):
+        """
+        Return an iterator over the keys, in order, of all rows whose
+        indexed fields have the given values, for example
+        store.find(location="room:123"). Rows are not decoded.
+        
+        Raises ValueError if a field has not been indexed.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        if not criteria:
+            raise ValueError("No criteria given.")
+        
+        queries = []
+        parameters = []
+        for field, value in criteria.iteritems():
+            if not field in self.indexes:
+                raise ValueError("Field '%s' is not indexed." % field)
+            
+            queries.append("SELECT key FROM pants_index WHERE field=? AND value=?")
+            parameters.extend((field, value))
+        
+        sql = " INTERSECT ".join(queries) + " ORDER BY key"
+        
+        def include(key, entry):
+            for field, value in criteria.iteritems():
+                for prefix in self.indexes[field]:
+                    if key.startswith(prefix):
+                        break
+                else:
+                    return False
+                
+                if index_value(entry[2], field) != value:
+                    return False
+            
+            return True
+        
+        return self._select_keys(sql, parameters, ordered=True, include=include)
+    
     def keys(self):
         """
         Return a copy of the store's list of keys.
@@ -247,34 +1643,162 @@ class Store(UserDict.DictMixin):
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        sql = "SELECT key FROM pants_data"
-        cur = self.con.cursor()
-        cur.execute(sql)
+        return self._select_keys("SELECT key FROM pants_data")
+    
+    def iteritems(self):
+        """
+        Return an iterator over the store's (key, value) pairs, in key
+        order.
+        """
+        return self.scan()
+    
+    def itervalues(self):
+        """
+        Return an iterator over the store's values, in key order.
+        """
+        for key, data in self.scan():
+            yield data
+    
+    def scan(self, prefix="", fetch_size=None):
+        """
+        Return an iterator over the (key, value) pairs, in key order, of
+        all keys that begin with the given prefix. Keys and data are
+        read together, a batch of rows at a time, in a single pass.
         
-        row = cur.fetchone()
-        while row:
-            key, = row
-            yield key
-            row = cur.fetchone()
+        Values are decoded straight from the database and are not added
+        to the cache, so full scans do not evict the working set.
+        
+        Parameters:
+            prefix - The key prefix. Defaults to "", which covers every
+                key.
+            fetch_size - The number of rows to fetch at a time. If None,
+                the store's fetch_size is used. Defaults to None.
+        """
+        for key, tag, raw_data in self.scan_raw(prefix, fetch_size):
+            yield key, decode(tag, raw_data)
+    
+    def scan_raw(self, prefix="", fetch_size=None):
+        """
+        Return an iterator over the (key, codec, serialised data) tuples,
+        in key order, of all keys that begin with the given prefix. Like
+        scan(), but leaves decoding to the caller, which may then decode
+        elsewhere, such as in another process.
+        
+        Parameters:
+            prefix - The key prefix. Defaults to "", which covers every
+                key.
+            fetch_size - The number of rows to fetch at a time. If None,
+                the store's fetch_size is used. Defaults to None.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        start, end = prefix_range(prefix)
+        shards = self._shards_for(prefix)
+        
+        def overlay(key, entry):
+            if key >= start and (end is None or key < end):
+                return key, entry[0], entry[1]
+        
+        if end is None:
+            sql = ("SELECT key, codec, data FROM pants_data WHERE key >= ? "
+                   "ORDER BY key")
+            rows = self._select(sql, (start,), shards, True, fetch_size,
+                                overlay)
+        else:
+            sql = ("SELECT key, codec, data FROM pants_data "
+                   "WHERE key >= ? AND key < ? ORDER BY key")
+            rows = self._select(sql, (start, end), shards, True, fetch_size,
+                                overlay)
+        
+        return rows
+    
+    def scan_range(self, start, end=None, shards=None):
+        """
+        Return an iterator over all keys, in order, that are greater
+        than or equal to start and less than end. The scan uses the
+        primary key index. Comparison is case-sensitive.
+        
+        Parameters:
+            start - The lowest key to include.
+            end - The first key to exclude. If None, the scan runs to
+                the last key. Defaults to None.
+            shards - The shards to scan. If None, every shard is
+                scanned. Defaults to None.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        include = lambda key, entry: key >= start and (end is None or key < end)
+        
+        if end is None:
+            sql = "SELECT key FROM pants_data WHERE key >= ? ORDER BY key"
+            return self._select_keys(sql, (start,), shards, True, include)
+        
+        sql = "SELECT key FROM pants_data WHERE key >= ? AND key < ? ORDER BY key"
+        return self._select_keys(sql, (start, end), shards, True, include)
+    
+    def scan_prefix(self, prefix):
+        """
+        Return an iterator over all keys, in order, that begin with the
+        given prefix. Comparison is case-sensitive. Only the shards that
+        may hold such keys are scanned.
+        
+        Parameters:
+            prefix - The key prefix, such as "player:".
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        start, end = prefix_range(prefix)
+        return self.scan_range(start, end, self._shards_for(prefix))
     
     def select(self, pattern="%"):
         """
         Return an iterator over all keys which match the given
         pattern.
+        
+        Patterns of the form "prefix%", where the prefix contains no
+        other wildcards, are answered with an indexed (and therefore
+        case-sensitive) prefix scan. Any other pattern falls back to
+        match().
         """
         if not self.connected:
             raise NotConnectedError("Store is not connected.")
         
-        sql = "SELECT key FROM pants_data WHERE key LIKE ?"
+        prefix = pattern[:-1]
+        if pattern.endswith("%") and not "%" in prefix and not "_" in prefix:
+            return self.scan_prefix(prefix)
         
-        cur = self.con.cursor()
-        cur.execute(sql, (pattern,))
+        return self.match(pattern)
+    
+    def match(self, pattern, glob=False):
+        """
+        Return an iterator over all keys which match the given SQL LIKE
+        pattern, or GLOB pattern if glob is True. Unlike select(), this
+        always scans the whole table.
         
-        row = cur.fetchone()
-        while row:
-            key, = row
-            yield key
-            row = cur.fetchone()
+        Parameters:
+            pattern - The pattern to match keys against.
+            glob - If True, the pattern is a case-sensitive, Unix-style
+                glob. Defaults to False.
+        """
+        if not self.connected:
+            raise NotConnectedError("Store is not connected.")
+        
+        if glob:
+            operator = "GLOB"
+        else:
+            operator = "LIKE"
+        
+        def include(key, entry):
+            # Let SQLite apply the pattern, so buffered keys match alike.
+            cur = self.con.cursor()
+            cur.execute("SELECT ? %s ?" % operator, (key, pattern))
+            return bool(cur.fetchone()[0])
+        
+        sql = "SELECT key FROM pants_data WHERE key %s ?" % operator
+        return self._select_keys(sql, (pattern,), include=include)
 
 
 ###############################################################################
@@ -0,0 +1,123 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import weakref
+from copy import deepcopy
+
+
+###############################################################################
+# Tracked Container Classes
+###############################################################################
+
+class TrackedList(list):
+    """
+    A list which marks its owner as dirty whenever it is modified in
+    place. Only the list itself is tracked, not the values in it.
+    """
+    __slots__ = ("_owner",)
+    
+    def __init__(self, owner, iterable=()):
+        """
+        Initialise the list.
+        
+        Parameters:
+            owner - The object to mark as dirty, which must have a
+                mark_dirty() method.
+            iterable - The list's initial contents.
+        """
+        list.__init__(self, iterable)
+        self._owner = weakref.ref(owner)
+    
+    def __deepcopy__(self, memo):
+        # Copies are plain lists, so they can be serialised by any codec.
+        return deepcopy(list(self), memo)
+
+
+class TrackedDict(dict):
+    """
+    A dictionary which marks its owner as dirty whenever it is modified
+    in place. Only the dictionary itself is tracked, not the values in
+    it.
+    """
+    __slots__ = ("_owner",)
+    
+    def __init__(self, owner, *args, **kwargs):
+        """
+        Initialise the dictionary.
+        
+        Parameters:
+            owner - The object to mark as dirty, which must have a
+                mark_dirty() method.
+            *args, **kwargs - The dictionary's initial contents.
+        """
+        dict.__init__(self, *args, **kwargs)
+        self._owner = weakref.ref(owner)
+    
+    def __deepcopy__(self, memo):
+        # Copies are plain dicts, so they can be serialised by any codec.
+        return deepcopy(dict(self), memo)
+
+
+#: The tracked container types.
+TRACKED_TYPES = frozenset((TrackedList, TrackedDict))
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def _tracking(method):
+    """
+    Returns a wrapper for a container method which marks the
+    container's owner as dirty after calling the method.
+    
+    Parameters:
+        method - An unbound list or dict method.
+    """
+    def tracking(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        
+        owner = self._owner()
+        if owner is not None:
+            owner.mark_dirty()
+        
+        return result
+    
+    tracking.__name__ = method.__name__
+    tracking.__doc__ = method.__doc__
+    return tracking
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+for _name in ("__setitem__", "__delitem__", "__setslice__", "__delslice__",
+              "__iadd__", "__imul__", "append", "extend", "insert", "pop",
+              "remove", "reverse", "sort"):
+    setattr(TrackedList, _name, _tracking(getattr(list, _name)))
+
+for _name in ("__setitem__", "__delitem__", "clear", "pop", "popitem",
+              "setdefault", "update"):
+    setattr(TrackedDict, _name, _tracking(getattr(dict, _name)))
+
+del _name
@@ -20,7 +20,7 @@
 # Imports
 ###############################################################################
 
-from pants import engine, callback
+from pants import engine, loop
 from mud import *
 from mud import MUDServer
 
@@ -32,15 +32,24 @@ import log
 ###############################################################################
 
 if __name__ == "__main__":
-    # Connect to the storage database.
-    store.connect("pantsmud.db")
+    # Connect to the storage database. Writes are buffered in the cache
+    # and flushed in batches by the auto-commit loop below.
+    store.connect("pantsmud.db", cache_size=10000)
     
     # Create our servers.
     t = MUDServer()
     t.listen(port=4000)
 
-    # Start storage auto-commit callback.
-    callback(store.commit)
+    # Start dirty object flush loop, which dumps every changed object
+    # ahead of the commit below on every iteration of the engine.
+    loop(flush_dirty)
+    
+    # Start storage auto-commit loop, run on every iteration of the
+    # engine. This also flushes any writes buffered by the store's cache.
+    loop(store.commit)
+    
+    # Start deferred event delivery loop.
+    loop(publisher.drain)
  
     # Start the engine.
     engine.start()
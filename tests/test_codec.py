@@ -0,0 +1,75 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import json
+import unittest
+import zlib
+
+from mud.codec import codecs, decode, encode
+
+
+###############################################################################
+# Constants
+###############################################################################
+
+DATA = {"name": u"caf\xe9", "hp": 10, "regen": 0.5, "exits": [1, 2, 3],
+        "flags": {"dark": True}, "owner": None}
+
+
+###############################################################################
+# Test Cases
+###############################################################################
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name in codecs:
+            tag, raw_data = encode(DATA, name)
+            self.assertEqual(tag, name)
+            self.assertEqual(decode(tag, raw_data), DATA)
+    
+    def test_untagged_rows_are_json(self):
+        self.assertEqual(decode(None, json.dumps(DATA)), DATA)
+    
+    def test_compress_threshold(self):
+        raw_size = len(codecs["json"].encode(DATA))
+        
+        tag, raw_data = encode(DATA, "json", raw_size + 1)
+        self.assertEqual(tag, "json")
+        
+        for name in codecs:
+            tag, raw_data = encode(DATA, name, 1)
+            self.assertEqual(tag, name + "+zlib")
+            self.assertEqual(zlib.decompress(raw_data),
+                             codecs[name].encode(DATA))
+            self.assertEqual(decode(tag, raw_data), DATA)
+    
+    def test_unknown_tags(self):
+        self.assertRaises(ValueError, decode, "nope", "")
+        self.assertRaises(ValueError, decode, "json+nope", "{}")
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    unittest.main()
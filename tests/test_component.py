@@ -0,0 +1,84 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import unittest
+
+from mud.component import ColumnarComponent
+
+
+###############################################################################
+# Component Classes
+###############################################################################
+
+class Owner(object):
+    pass
+
+
+class Health(ColumnarComponent):
+    fields = (("hp", "i", 100), ("regen", "f", 1.0))
+
+
+class Mana(Health):
+    fields = (("mp", "i", 50),)
+
+
+###############################################################################
+# Test Cases
+###############################################################################
+
+class ColumnarComponentTest(unittest.TestCase):
+    def setUp(self):
+        self.owner = Owner()
+    
+    def test_defaults_and_round_trip(self):
+        health = Health(self.owner)
+        self.assertEqual(health.dump_data(), {"hp": 100, "regen": 1.0})
+        
+        health.load_data({"hp": 12, "regen": 0.5})
+        self.assertEqual(health.hp, 12)
+        self.assertEqual(Health.columns["hp"][health._row], 12)
+        self.assertEqual(health.dump_data(), {"hp": 12, "regen": 0.5})
+    
+    def test_load_converts_to_field_type(self):
+        health = Health(self.owner)
+        health.load_data({"hp": 3.5, "regen": 2})
+        
+        self.assertEqual(health.hp, 3)
+        self.assertTrue(isinstance(health.regen, float))
+        self.assertEqual(health.regen, 2.0)
+    
+    def test_inherited_fields(self):
+        mana = Mana(self.owner)
+        mana.load_data({"hp": 7, "mp": 9})
+        
+        self.assertEqual([field[0] for field in Mana.fields],
+                         ["hp", "regen", "mp"])
+        self.assertEqual(mana.dump_data(), {"hp": 7, "regen": 1.0, "mp": 9})
+        self.assertEqual(Mana.columns["hp"][mana._row], 7)
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,290 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+from mud.component import Component
+from mud.object import (IdentityMap, LAZY_FIELDS, LAZY_KEY, Object,
+                        flush_dirty, identity_map)
+from mud.store import store
+
+
+###############################################################################
+# Object Classes
+###############################################################################
+
+class Room(Object):
+    def __init__(self, key):
+        Object.__init__(self, key)
+        
+        self.name = ""
+
+
+class Book(Object):
+    lazy = ("text",)
+    
+    def __init__(self, key):
+        Object.__init__(self, key)
+        
+        self.title = ""
+        self.text = ""
+
+
+class Inventory(Component):
+    tracked = ("items",)
+    
+    def __init__(self, owner):
+        Component.__init__(self, owner)
+        
+        self.items = []
+    
+    def load_data(self, data):
+        self.items.extend(data.get("items", ()))
+    
+    def dump_data(self):
+        return {"items": list(self.items)}
+
+
+class Mob(Object):
+    pass
+
+Mob.add_component(Inventory)
+
+
+###############################################################################
+# Test Cases
+###############################################################################
+
+class ObjectTestCase(unittest.TestCase):
+    """
+    Connects the global store to an in-memory database and empties the
+    identity map around each test.
+    """
+    def setUp(self):
+        store.connect(":memory:")
+        identity_map.clear()
+    
+    def tearDown(self):
+        identity_map.clear()
+        store.close()
+    
+    def create(self, cls, key, **attrs):
+        """
+        Create an instance, set its attributes and dump it.
+        """
+        obj = cls(key)
+        for name, value in attrs.iteritems():
+            setattr(obj, name, value)
+        
+        obj.dump()
+        return obj
+
+
+class IdentityMapTest(ObjectTestCase):
+    def test_get_reuses_live_instance(self):
+        room = self.create(Room, "room:1", name="hall")
+        
+        self.assertTrue(Room.get("room:1") is room)
+        self.assertEqual(Room.get_many(["room:1"]), [room])
+    
+    def test_get_ignores_unloaded_instance(self):
+        self.create(Room, "room:1", name="hall")
+        identity_map.clear()
+        
+        blank = Room("room:1")
+        room = Room.get("room:1")
+        
+        self.assertFalse(room is blank)
+        self.assertEqual(room.name, "hall")
+        self.assertTrue("room:1" in identity_map)
+    
+    def test_get_many_loads_missing_once(self):
+        self.create(Room, "room:1", name="hall")
+        self.create(Room, "room:2", name="attic")
+        identity_map.clear()
+        
+        rooms = Room.get_many(["room:1", "room:2", "room:1"])
+        
+        self.assertTrue(rooms[0] is rooms[2])
+        self.assertEqual([r.name for r in rooms], ["hall", "attic", "hall"])
+        self.assertTrue(Room.get("room:2") is rooms[1])
+    
+    def test_recent_objects_kept_alive(self):
+        identity_map.size = 2
+        try:
+            for i in xrange(3):
+                self.create(Room, "room:%d" % i)
+            gc.collect()
+            
+            # Only the two most recently used are still held strongly.
+            self.assertFalse("room:0" in identity_map)
+            self.assertTrue("room:1" in identity_map)
+            self.assertTrue("room:2" in identity_map)
+        finally:
+            identity_map.size = IdentityMap().size
+    
+    def test_touch_refreshes_recent(self):
+        map = IdentityMap(2)
+        rooms = [Room("room:%d" % i) for i in xrange(3)]
+        
+        map.add(rooms[0])
+        map.add(rooms[1])
+        map.get("room:0")
+        map.add(rooms[2])
+        
+        self.assertEqual(list(map._recent), ["room:0", "room:2"])
+
+
+class DirtyTrackingTest(ObjectTestCase):
+    def test_new_instances_are_not_tracked(self):
+        room = Room("room:1")
+        room.name = "hall"
+        
+        self.assertFalse(room.dirty)
+        self.assertEqual(flush_dirty(), 0)
+        self.assertFalse("room:1" in store)
+    
+    def test_loaded_instances_are_tracked(self):
+        self.create(Room, "room:1", name="hall")
+        identity_map.clear()
+        
+        room = Room.get("room:1")
+        self.assertFalse(room.dirty)
+        
+        room.name = "attic"
+        self.assertTrue(room.dirty)
+        self.assertEqual(flush_dirty(), 1)
+        self.assertEqual(store["room:1"]["name"], "attic")
+        self.assertFalse(room.dirty)
+    
+    def test_loading_component_does_not_dirty(self):
+        mob = Mob("mob:1")
+        mob.inventory.items.append("sword")
+        mob.dump()
+        identity_map.clear()
+        
+        mob = Mob.get("mob:1")
+        self.assertEqual(list(mob.inventory.items), ["sword"])
+        self.assertFalse(mob.dirty)
+        
+        mob.inventory.items.append("shield")
+        self.assertTrue(mob.dirty)
+        flush_dirty()
+        self.assertEqual(store["mob:1"]["components"]["inventory"]["items"],
+                         ["sword", "shield"])
+    
+    def test_close_flushes_dirty(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "test.db")
+            store.connect(filename)
+            
+            room = self.create(Room, "room:1", name="hall")
+            room.name = "attic"
+            
+            # Closing dumps the change ahead of the final commit.
+            store.close()
+            self.assertFalse(room.dirty)
+            
+            store.connect(filename)
+            self.assertEqual(store["room:1"]["name"], "attic")
+        finally:
+            shutil.rmtree(directory)
+
+
+class LazyAttributeTest(ObjectTestCase):
+    def setUp(self):
+        ObjectTestCase.setUp(self)
+        
+        self.create(Book, "book:1", title="Tales", text="Once upon a time")
+        self.create(Book, "book:10", title="Notes")
+        identity_map.clear()
+    
+    def test_stored_separately(self):
+        self.assertEqual(store[LAZY_KEY % ("book:1", "text")], "Once upon a time")
+        self.assertFalse("text" in store["book:1"])
+        self.assertEqual(store["book:1"][LAZY_FIELDS], ["text"])
+    
+    def test_rows_stay_out_of_prefix_scans(self):
+        self.assertEqual(list(store.scan_prefix("book:1")), ["book:1", "book:10"])
+        self.assertEqual([key for key, data in store.scan("book:")],
+                         ["book:1", "book:10"])
+        self.assertEqual(sorted(store.get_many(["book:1", "book:10"])),
+                         ["book:1", "book:10"])
+    
+    def test_fetched_on_access_without_dirtying(self):
+        book = Book.get("book:1")
+        self.assertFalse("text" in book.__dict__)
+        
+        self.assertEqual(book.text, "Once upon a time")
+        self.assertFalse(book.dirty)
+    
+    def test_unfetched_kept_on_dump(self):
+        book = Book.get("book:1")
+        book.title = "More Tales"
+        book.dump()
+        
+        self.assertEqual(store["book:1"][LAZY_FIELDS], ["text"])
+        self.assertEqual(store[LAZY_KEY % ("book:1", "text")], "Once upon a time")
+        
+        identity_map.clear()
+        self.assertEqual(Book.get("book:1").text, "Once upon a time")
+    
+    def test_dump_data_round_trip(self):
+        book = Book.get("book:1")
+        keys = sorted(store.keys())
+        
+        # Unfetched attributes are listed, not written.
+        data = book.dump_data()
+        self.assertEqual(data[LAZY_FIELDS], ["text"])
+        self.assertFalse("text" in data)
+        self.assertEqual(sorted(store.keys()), keys)
+        
+        # Fetched attributes are returned inline.
+        book.text
+        data = book.dump_data()
+        self.assertEqual(data["text"], "Once upon a time")
+        self.assertFalse(LAZY_FIELDS in data)
+        
+        copy = Book("book:2")
+        copy.load_data(data)
+        self.assertEqual(copy.__dict__["text"], "Once upon a time")
+    
+    def test_changed_lazy_attribute_flushed(self):
+        book = Book.get("book:1")
+        book.text = "The end"
+        
+        self.assertTrue(book.dirty)
+        self.assertEqual(flush_dirty(), 1)
+        self.assertEqual(store[LAZY_KEY % ("book:1", "text")], "The end")
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import unittest
+
+from mud.publisher import Publisher
+
+
+###############################################################################
+# Test Cases
+###############################################################################
+
+class PatternTest(unittest.TestCase):
+    def setUp(self):
+        self.publisher = Publisher()
+        self.received = []
+    
+    def subscribe(self, event):
+        self.publisher.subscribe(event, lambda: self.received.append(event))
+    
+    def test_patterns(self):
+        self.subscribe("mud.*")
+        self.subscribe("mud.*.connect")
+        
+        self.publisher.publish("mud.connection.connect")
+        self.publisher.publish("mud")
+        self.publisher.publish("pants.engine.stop")
+        
+        self.assertEqual(self.received, ["mud.*", "mud.*.connect"])
+    
+    def test_non_string_events(self):
+        self.subscribe(42)
+        self.subscribe(("mud", 1))
+        self.subscribe("mud.*")
+        
+        self.publisher.publish(42)
+        self.publisher.publish(("mud", 1))
+        self.publisher.publish("mud.tick")
+        
+        self.assertEqual(self.received, [42, ("mud", 1), "mud.*"])
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    unittest.main()
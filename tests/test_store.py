@@ -0,0 +1,464 @@
+###############################################################################
+#
+# Copyright 2011 Chris Davis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+
+###############################################################################
+# Imports
+###############################################################################
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from mud.store import Cache, Store, prefix_range
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+def read_row(filename, key):
+    """
+    Return the raw data stored for a key in a database file, read with a
+    separate connection, or None if there is no such row.
+    
+    Parameters:
+        filename - The database file.
+        key - The key to look up.
+    """
+    con = sqlite3.connect(filename)
+    try:
+        row = con.execute("SELECT data FROM pants_data WHERE key=?",
+                          (key,)).fetchone()
+    finally:
+        con.close()
+    
+    return row and row[0]
+
+
+###############################################################################
+# Test Cases
+###############################################################################
+
+class StoreTestCase(unittest.TestCase):
+    """
+    Provides a temporary directory for database files, and closes any
+    stores opened with connect().
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stores = []
+    
+    def tearDown(self):
+        for store in self.stores:
+            if store.connected:
+                store.close()
+        
+        shutil.rmtree(self.directory)
+    
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def connect(self, filename="test.db", **kwargs):
+        store = Store()
+        for field, prefix in kwargs.pop("indexes", ()):
+            store.add_index(field, prefix)
+        
+        store.connect(self.path(filename), **kwargs)
+        self.stores.append(store)
+        return store
+
+
+class CacheTest(unittest.TestCase):
+    def test_evicts_by_count(self):
+        cache = Cache(max_items=2)
+        cache.put("a", 1, 10)
+        cache.put("b", 2, 10)
+        cache.get("a") # "b" is now the least recently used.
+        cache.put("c", 3, 10)
+        
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+    
+    def test_evicts_by_bytes(self):
+        cache = Cache(max_bytes=100)
+        cache.put("a", 1, 40)
+        cache.put("b", 2, 40)
+        cache.put("c", 3, 40)
+        
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.size, 80)
+        
+        # Replacing an entry counts only its new size.
+        cache.put("b", 2, 10)
+        self.assertEqual(cache.size, 50)
+        
+        # An entry larger than the whole cache is not held.
+        cache.put("d", 4, 101)
+        self.assertFalse("d" in cache)
+        self.assertEqual(len(cache), 2)
+        
+        cache.discard("b")
+        self.assertEqual(cache.size, 40)
+    
+    def test_counters(self):
+        cache = Cache()
+        cache.put("a", 1, 10)
+        
+        self.assertEqual(cache.get("a"), 1)
+        self.assertRaises(KeyError, cache.get, "b")
+        self.assertRaises(KeyError, cache.get, "c")
+        
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertAlmostEqual(stats["hit_ratio"], 1 / 3.0)
+        self.assertEqual((stats["items"], stats["bytes"]), (1, 10))
+        
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+
+class BufferedStoreTest(StoreTestCase):
+    def test_pending_writes_visible(self):
+        store = self.connect(cache_size=1)
+        store["mob:1"] = {"hp": 1}
+        store["mob:2"] = {"hp": 2} # Evicts "mob:1" from the cache.
+        
+        self.assertFalse("mob:1" in store.cache)
+        self.assertEqual(read_row(self.path("test.db"), "mob:1"), None)
+        
+        self.assertEqual(store["mob:1"], {"hp": 1})
+        self.assertTrue("mob:1" in store)
+        self.assertEqual(store.get_many(["mob:1", "mob:2", "mob:3"]),
+                         {"mob:1": {"hp": 1}, "mob:2": {"hp": 2}})
+        
+        store.commit()
+        self.assertNotEqual(read_row(self.path("test.db"), "mob:1"), None)
+    
+    def test_pending_deletes_visible(self):
+        store = self.connect(cache_size=10)
+        store.set_many([("mob:1", {"hp": 1}), ("mob:2", {"hp": 2})])
+        store.commit()
+        
+        del store["mob:1"]
+        store.delete_many(["mob:2"])
+        
+        self.assertNotEqual(read_row(self.path("test.db"), "mob:1"), None)
+        self.assertRaises(KeyError, lambda: store["mob:1"])
+        self.assertFalse("mob:1" in store)
+        self.assertFalse("mob:2" in store)
+        self.assertEqual(store.get_many(["mob:1", "mob:2"]), {})
+        
+        store.commit()
+        self.assertEqual(read_row(self.path("test.db"), "mob:1"), None)
+        self.assertEqual(len(store), 0)
+    
+    def test_reads_are_cached(self):
+        store = self.connect()
+        store["mob:1"] = {"hp": 1}
+        store.close()
+        
+        store = self.connect(cache_size=10)
+        self.assertEqual(store["mob:1"], {"hp": 1})
+        self.assertEqual(store["mob:1"], {"hp": 1})
+        self.assertEqual(store.get_many(["mob:1"]), {"mob:1": {"hp": 1}})
+        
+        stats = store.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+
+class ThreadedStoreTest(StoreTestCase):
+    def block_writer(self, store):
+        """
+        Stall the default shard's writer until the returned event is set.
+        """
+        event = threading.Event()
+        store.shards[0].writer.submit(lambda con: event.wait())
+        return event
+    
+    def test_read_your_writes_in_flight(self):
+        store = self.connect(threaded=True)
+        release = self.block_writer(store)
+        
+        try:
+            store["mob:1"] = {"hp": 10}
+            store.commit(override=True) # Handed to the stalled writer.
+            
+            self.assertTrue(store.shards[0].inflight)
+            self.assertEqual(read_row(self.path("test.db"), "mob:1"), None)
+            
+            self.assertEqual(store["mob:1"], {"hp": 10})
+            self.assertTrue("mob:1" in store)
+            self.assertEqual(store.get_many(["mob:1"]), {"mob:1": {"hp": 10}})
+            
+            del store["mob:1"]
+            store.commit(override=True)
+            self.assertRaises(KeyError, lambda: store["mob:1"])
+        finally:
+            release.set()
+        
+        self.assertTrue(store.barrier(timeout=5))
+        self.assertEqual(read_row(self.path("test.db"), "mob:1"), None)
+        self.assertRaises(KeyError, lambda: store["mob:1"])
+    
+    def test_queries_do_not_wait_for_writer(self):
+        store = self.connect(threaded=True, indexes=[("location", "mob:")])
+        store.set_many([("mob:1", {"location": "room:1"}),
+                        ("mob:3", {"location": "room:1"})])
+        self.assertTrue(store.barrier(timeout=5))
+        
+        release = self.block_writer(store)
+        
+        try:
+            store["mob:2"] = {"location": "room:1"}
+            store["mob:3"] = {"location": "room:2"}
+            store.commit(override=True) # Handed to the stalled writer.
+            del store["mob:1"]
+            store["room:1"] = {}
+            
+            start = time.time()
+            
+            self.assertEqual(len(store), 3)
+            self.assertEqual(sorted(store.keys()), ["mob:2", "mob:3", "room:1"])
+            self.assertEqual(list(store.scan_prefix("mob:")), ["mob:2", "mob:3"])
+            self.assertEqual(list(store.scan("mob:")),
+                             [("mob:2", {"location": "room:1"}),
+                              ("mob:3", {"location": "room:2"})])
+            self.assertEqual(list(store.find(location="room:1")), ["mob:2"])
+            self.assertEqual(list(store.match("room%")), ["room:1"])
+            
+            self.assertTrue(time.time() - start < 1)
+            self.assertTrue(store.shards[0].inflight)
+        finally:
+            release.set()
+        
+        self.assertTrue(store.barrier(timeout=5))
+        self.assertEqual(sorted(store.keys()), ["mob:2", "mob:3", "room:1"])
+        self.assertEqual(list(store.find(location="room:1")), ["mob:2"])
+    
+    def test_barrier_persists(self):
+        store = self.connect(threaded=True)
+        store["mob:1"] = {"hp": 10}
+        
+        self.assertTrue(store.barrier(timeout=5))
+        self.assertNotEqual(read_row(self.path("test.db"), "mob:1"), None)
+    
+    def test_close_persists(self):
+        store = self.connect(threaded=True, cache_size=10)
+        store["mob:1"] = {"hp": 10}
+        store.close()
+        
+        store = self.connect()
+        self.assertEqual(store["mob:1"], {"hp": 10})
+
+
+class ShardedStoreTest(StoreTestCase):
+    def test_prefix_routing(self):
+        store = self.connect("world.db", shards={"mob:": self.path("mobs.db")})
+        
+        store["mob:1"] = {"name": "orc"}
+        store["room:1"] = {"name": "hall"}
+        store.commit(override=True)
+        
+        self.assertNotEqual(read_row(self.path("mobs.db"), "mob:1"), None)
+        self.assertEqual(read_row(self.path("mobs.db"), "room:1"), None)
+        self.assertNotEqual(read_row(self.path("world.db"), "room:1"), None)
+        self.assertEqual(read_row(self.path("world.db"), "mob:1"), None)
+        
+        self.assertEqual(len(store), 2)
+        self.assertEqual([key for key, data in store.scan("mob:")], ["mob:1"])
+        self.assertEqual(list(store.scan_prefix("room:")), ["room:1"])
+        self.assertEqual(sorted(store.keys()), ["mob:1", "room:1"])
+    
+    def test_hashed_routing(self):
+        store = self.connect("world.db", shards=4,
+                             indexes=[("location", "mob:")])
+        
+        keys = ["mob:%d" % i for i in xrange(50)]
+        store.set_many((key, {"location": "room:%d" % (i % 2)})
+                       for i, key in enumerate(keys))
+        store.commit(override=True)
+        
+        # Every key is in exactly one shard, and the keys are spread.
+        counts = []
+        for i in xrange(4):
+            filename = self.path("world.%d.db" % i)
+            found = [key for key in keys if read_row(filename, key)]
+            counts.append(len(found))
+        
+        self.assertEqual(sum(counts), 50)
+        self.assertTrue(all(counts))
+        
+        self.assertEqual(len(store), 50)
+        self.assertEqual([key for key, data in store.scan("mob:")],
+                         sorted(keys))
+        self.assertEqual(list(store.find(location="room:1")),
+                         sorted(keys[1::2]))
+    
+    def test_hashed_routing_threaded(self):
+        store = self.connect("world.db", shards=2, threaded=True,
+                             indexes=[("location", "mob:")])
+        
+        store.set_many(("mob:%d" % i, {"location": "room:1"})
+                       for i in xrange(10))
+        store.commit(override=True)
+        
+        # Scans see writes that are still in flight.
+        self.assertEqual(len(store), 10)
+        self.assertEqual(len(list(store.find(location="room:1"))), 10)
+
+
+class PrefixTest(StoreTestCase):
+    def test_prefix_range(self):
+        self.assertEqual(prefix_range("mob:"), (u"mob:", u"mob;"))
+        self.assertEqual(prefix_range("caf\xc3\xa9"), (u"caf\xe9", u"caf\xea"))
+        self.assertEqual(prefix_range(u"caf\xe9"), (u"caf\xe9", u"caf\xea"))
+        self.assertEqual(prefix_range(""), (u"", None))
+    
+    def test_non_ascii_prefix(self):
+        store = self.connect()
+        for key in (u"caf\xe9:1", u"caf\xe9:2", u"cafe:1", u"caf\xea:1"):
+            store[key] = {}
+        
+        expected = [u"caf\xe9:1", u"caf\xe9:2"]
+        for prefix in ("caf\xc3\xa9", u"caf\xe9"):
+            self.assertEqual(list(store.scan_prefix(prefix)), expected)
+            self.assertEqual([key for key, data in store.scan(prefix)], expected)
+        
+        self.assertEqual(list(store.select("caf\xc3\xa9%")), expected)
+
+
+class CodecStoreTest(StoreTestCase):
+    def read_tags(self, filename="test.db"):
+        """
+        Return a dictionary of every key in a database file to its codec
+        tag.
+        """
+        con = sqlite3.connect(self.path(filename))
+        try:
+            return dict(con.execute("SELECT key, codec FROM pants_data"))
+        finally:
+            con.close()
+    
+    def test_mixed_codecs(self):
+        store = self.connect(codec="json")
+        store["mob:1"] = {"hp": 1}
+        store.close()
+        
+        store = self.connect(codec="marshal", compress_threshold=100)
+        store["mob:2"] = {"hp": 2}
+        store["mob:3"] = {"text": "x" * 200}
+        store.commit(override=True)
+        
+        self.assertEqual(self.read_tags(), {"mob:1": "json",
+                                            "mob:2": "marshal",
+                                            "mob:3": "marshal+zlib"})
+        self.assertEqual(store["mob:1"], {"hp": 1})
+        self.assertEqual(store["mob:2"], {"hp": 2})
+        self.assertEqual(store["mob:3"], {"text": "x" * 200})
+        self.assertEqual([data for key, data in store.scan("mob:")],
+                         [{"hp": 1}, {"hp": 2}, {"text": "x" * 200}])
+    
+    def test_legacy_database(self):
+        con = sqlite3.connect(self.path("test.db"))
+        con.execute("CREATE TABLE pants_data (key TEXT UNIQUE PRIMARY KEY "
+                    "NOT NULL, data TEXT NOT NULL)")
+        con.execute("INSERT INTO pants_data VALUES (?, ?)",
+                    ("mob:1", '{"hp": 1}'))
+        con.commit()
+        con.close()
+        
+        store = self.connect(codec="marshal")
+        self.assertEqual(store["mob:1"], {"hp": 1})
+        self.assertEqual(self.read_tags(), {"mob:1": None})
+        
+        store["mob:2"] = {"hp": 2}
+        store.commit(override=True)
+        self.assertEqual(self.read_tags(), {"mob:1": None, "mob:2": "marshal"})
+        self.assertEqual(store.get_many(["mob:1", "mob:2"]),
+                         {"mob:1": {"hp": 1}, "mob:2": {"hp": 2}})
+    
+    def test_reencode(self):
+        store = self.connect(indexes=[("location", "mob:")])
+        store.set_many(("mob:%02d" % i, {"location": "room:%d" % (i % 2)})
+                       for i in xrange(25))
+        store["room:1"] = {"text": "x" * 200}
+        store.close()
+        
+        store = self.connect()
+        store.reencode("marshal", 100, batch_size=4)
+        
+        tags = self.read_tags()
+        self.assertEqual(tags.pop("room:1"), "marshal+zlib")
+        self.assertEqual(set(tags.values()), set(["marshal"]))
+        self.assertEqual(store.codec, "marshal")
+        
+        self.assertEqual(store["mob:03"], {"location": "room:1"})
+        self.assertEqual(store["room:1"], {"text": "x" * 200})
+        self.assertEqual(len(list(store.find(location="room:1"))), 12)
+        
+        store.reencode("json", 0, batch_size=7)
+        self.assertEqual(set(self.read_tags().values()), set(["json"]))
+        self.assertEqual(store["room:1"], {"text": "x" * 200})
+    
+    def test_reencode_threaded(self):
+        store = self.connect(threaded=True)
+        store.set_many(("mob:%d" % i, {"hp": i}) for i in xrange(10))
+        store.reencode("marshal", batch_size=3)
+        
+        self.assertEqual(set(self.read_tags().values()), set(["marshal"]))
+        self.assertEqual(store["mob:7"], {"hp": 7})
+
+
+class IndexTest(StoreTestCase):
+    def test_recorded_index_is_maintained(self):
+        store = self.connect(indexes=[("location", "mob:")])
+        store["mob:1"] = {"location": "room:1"}
+        store.close()
+        
+        # A connection that does not declare the index still updates it.
+        store = self.connect()
+        store["mob:1"] = {"location": "room:2"}
+        store.close()
+        
+        store = self.connect(indexes=[("location", "mob:")])
+        self.assertEqual(list(store.find(location="room:1")), [])
+        self.assertEqual(list(store.find(location="room:2")), ["mob:1"])
+    
+    def test_set_many_repeated_key(self):
+        store = self.connect(indexes=[("location", "mob:")])
+        store.set_many([("mob:1", {"location": "a"}),
+                        ("mob:1", {"location": "b"})])
+        
+        self.assertEqual(store["mob:1"], {"location": "b"})
+        self.assertEqual(list(store.find(location="b")), ["mob:1"])
+
+
+###############################################################################
+# Initialisation
+###############################################################################
+
+if __name__ == "__main__":
+    unittest.main()